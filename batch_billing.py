@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""คำนวณค่าไฟฟ้าจากไฟล์มิเตอร์จำนวนมากแบบขนาน (ไม่ใช้ Streamlit)
+
+ตัวอย่าง:
+    python batch_billing.py "exports/*.txt" --file-type ble --customer residential --tariff tou -o bills.csv
+    python batch_billing.py exports/ --customer residential -o bills.parquet  (ตรวจประเภทไฟล์แต่ละไฟล์อัตโนมัติ)
+"""
+import argparse
+import csv
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from electricity_core import (
+    TARIFFS, FT_MODES, FILE_TYPE_AUTO, CSV_ENGINES, FT_MODE_PERIOD_END, ENERGY_METHODS, ENERGY_METHOD_FIXED, parse_data_file, compute_kwh,
+    format_gap_stats, calculate_bill
+)
+
+FILE_TYPE_ALIASES = {'auto': FILE_TYPE_AUTO, 'ble': 'BLE-iMeter', 'ipg': 'IPG', 'pea': 'มิเตอร์ PEA (CSV)'}
+RESULT_COLUMNS = [
+    'file', 'rows', 'data_period_start', 'data_period_end', 'total_kwh', 'kwh_peak', 'kwh_off_peak', 'demand_kw',
+    'base_energy_cost', 'demand_charge', 'service_charge', 'applicable_ft_rate', 'ft_cost', 'total_before_vat',
+    'vat_amount', 'final_bill', 'warnings', 'error'
+]
+RESULT_SCHEMA = pa.schema(
+    [('file', pa.string()), ('rows', pa.int64()), ('data_period_start', pa.string()), ('data_period_end', pa.string())]
+    + [(col, pa.float64()) for col in RESULT_COLUMNS[4:-2]]
+    + [('warnings', pa.string()), ('error', pa.string())]
+)
+PARQUET_BATCH_ROWS = 1000
+
+def collect_meter_files(inputs):
+    """รวมรายชื่อไฟล์จากโฟลเดอร์หรือ glob pattern (เรียงตามชื่อ ไม่ซ้ำ)"""
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths.extend(entry.path for entry in os.scandir(item) if entry.is_file())
+        else:
+            paths.extend(glob.glob(item, recursive=True))
+    return sorted(set(paths))
+
+def bill_meter_file(path, file_type, customer_key, tariff_key, ft_mode=FT_MODE_PERIOD_END, energy_method=ENERGY_METHOD_FIXED, csv_engine=None):
+    """อ่านไฟล์มิเตอร์หนึ่งไฟล์แล้วคืนผลการคำนวณเป็นหนึ่งแถว (ข้อผิดพลาดอยู่ในคอลัมน์ error)"""
+    row = dict.fromkeys(RESULT_COLUMNS); row['file'] = path
+    try:
+        with open(path, 'rb') as f:
+            df = parse_data_file(f, file_type, engine=csv_engine)
+        df['kWh'], gap_stats = compute_kwh(df, energy_method)
+        bill = calculate_bill(df, customer_key, tariff_key, ft_mode)
+        row['rows'] = len(df)
+        if bill.get('error'): row['error'] = bill['error']
+        else: row.update((key, bill[key]) for key in RESULT_COLUMNS if key in bill)
+        row['warnings'] = '; '.join((bill.get('warnings') or []) + [note for note in [format_gap_stats(gap_stats)] if note]) or None
+    except Exception as e:
+        row['error'] = str(e)
+    return row
+
+class ResultWriter:
+    """เขียนผลลัพธ์ทีละแถวลง CSV หรือ Parquet (เลือกจากนามสกุลไฟล์)"""
+    def __init__(self, output_path):
+        self.is_parquet = output_path.lower().endswith('.parquet')
+        self.output_path = output_path; self.pending = []
+        if self.is_parquet:
+            self.parquet_writer = None
+        else:
+            self.csv_file = open(output_path, 'w', newline='', encoding='utf-8-sig')
+            self.csv_writer = csv.DictWriter(self.csv_file, fieldnames=RESULT_COLUMNS); self.csv_writer.writeheader()
+
+    def write(self, row):
+        if not self.is_parquet:
+            self.csv_writer.writerow(row); return
+        self.pending.append(row)
+        if len(self.pending) >= PARQUET_BATCH_ROWS: self._flush_parquet()
+
+    def _flush_parquet(self):
+        if not self.pending: return
+        table = pa.Table.from_pylist(self.pending, schema=RESULT_SCHEMA)
+        if self.parquet_writer is None: self.parquet_writer = pq.ParquetWriter(self.output_path, RESULT_SCHEMA)
+        self.parquet_writer.write_table(table); self.pending = []
+
+    def close(self):
+        if self.is_parquet:
+            self._flush_parquet()
+            if self.parquet_writer is not None: self.parquet_writer.close()
+            else: pq.write_table(RESULT_SCHEMA.empty_table(), self.output_path)
+        else:
+            self.csv_file.close()
+
+def run_batch(paths, file_type, customer_key, tariff_key, output_path, workers=None, ft_mode=FT_MODE_PERIOD_END, progress_every=500, energy_method=ENERGY_METHOD_FIXED, csv_engine=None):
+    """คำนวณทุกไฟล์ด้วย ProcessPoolExecutor และเขียนผลตามลำดับไฟล์ คืนค่า (จำนวนไฟล์, จำนวนที่ผิดพลาด, จำนวนแถว, วินาที)"""
+    worker = partial(bill_meter_file, file_type=file_type, customer_key=customer_key, tariff_key=tariff_key, ft_mode=ft_mode, energy_method=energy_method, csv_engine=csv_engine)
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, min(32, len(paths) // (workers * 4) or 1))
+    writer = ResultWriter(output_path)
+    n_done = n_failed = n_rows = 0; started = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for row in executor.map(worker, paths, chunksize=chunksize):
+                writer.write(row)
+                n_done += 1; n_rows += row['rows'] or 0; n_failed += row['error'] is not None
+                if progress_every and n_done % progress_every == 0:
+                    elapsed = time.perf_counter() - started
+                    print(f"{n_done:,}/{len(paths):,} ไฟล์ ({n_done / elapsed:,.1f} ไฟล์/วินาที)", file=sys.stderr)
+    finally:
+        writer.close()
+    return n_done, n_failed, n_rows, time.perf_counter() - started
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="คำนวณค่าไฟฟ้าจากไฟล์มิเตอร์จำนวนมากแบบขนาน")
+    parser.add_argument('inputs', nargs='+', help="โฟลเดอร์หรือ glob pattern ของไฟล์มิเตอร์")
+    parser.add_argument('--file-type', default=FILE_TYPE_AUTO, choices=sorted(FILE_TYPE_ALIASES) + sorted(set(FILE_TYPE_ALIASES.values()) - {FILE_TYPE_AUTO}), help="ประเภทไฟล์ (auto: ตรวจจากต้นไฟล์, ble, ipg, pea)")
+    parser.add_argument('--customer', default='residential', choices=sorted(TARIFFS), help="ประเภทผู้ใช้")
+    parser.add_argument('--tariff', default='normal', choices=['normal', 'tou'], help="ประเภทอัตรา")
+    parser.add_argument('--ft-mode', default=FT_MODE_PERIOD_END, choices=FT_MODES, help="period_end: ใช้ Ft ของวันสุดท้าย, prorated: คิด Ft ตามงวดของแต่ละช่วงเวลา")
+    parser.add_argument('--energy-method', default=ENERGY_METHOD_FIXED, choices=ENERGY_METHODS, help="fixed: ช่วงเวลาคงที่จากสองแถวแรก, left/trapezoid: ตามช่วงเวลาจริง ตัดเวลาซ้ำและช่องว่าง")
+    parser.add_argument('--csv-engine', default='auto', choices=('auto',) + CSV_ENGINES, help="วิธีอ่านไฟล์ (auto: เลือกตามขนาดไฟล์, pandas, arrow)")
+    parser.add_argument('-o', '--output', required=True, help="ไฟล์ผลลัพธ์ (.csv หรือ .parquet)")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="จำนวน process (ค่าเริ่มต้น: จำนวน CPU)")
+    args = parser.parse_args(argv)
+
+    paths = collect_meter_files(args.inputs)
+    if not paths: parser.error("ไม่พบไฟล์มิเตอร์ตามที่ระบุ")
+    file_type = FILE_TYPE_ALIASES.get(args.file_type, args.file_type)
+
+    n_done, n_failed, n_rows, elapsed = run_batch(paths, file_type, args.customer, args.tariff, args.output, args.workers, args.ft_mode, energy_method=args.energy_method, csv_engine=None if args.csv_engine == 'auto' else args.csv_engine)
+    print(
+        f"คำนวณเสร็จ {n_done:,} ไฟล์ (ผิดพลาด {n_failed:,}) ใน {elapsed:.1f} วินาที: "
+        f"{n_done / elapsed:,.1f} ไฟล์/วินาที, {n_rows / elapsed:,.0f} แถว/วินาที -> {args.output}",
+        file=sys.stderr
+    )
+    return 1 if n_failed == n_done else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,27 @@
 # -*- coding: utf-8 -*-
 import streamlit as st
 import pandas as pd
-import io
 from datetime import datetime, time, date
-import calendar
 import traceback
 import numpy as np
 from datetime import datetime, time, date
 import base64
+import uuid
+from electricity_core import (
+    VAT_RATE, DEMAND_UNIT_NOTES, FILE_TYPE_AUTO, sniff_meter_file, detected_file_type, load_meter_data, parsed_cache_key, DATASET_REGISTRY, ENERGY_METHOD_FIXED, ENERGY_METHOD_LEFT,
+    ENERGY_METHOD_TRAPEZOID, compute_kwh, format_gap_stats, sweep_ev_scenarios, schedule_ev_charging,
+    calculate_cycle_bills, CHART_MAX_POINTS, DOWNSAMPLE_MINMAX, DOWNSAMPLE_LTTB, downsample_series,
+    build_load_pyramid, select_pyramid_level, DemandStats, compact_meter_frame, HOUR_DTYPE,
+    FT_MODE_PERIOD_END, FT_MODE_PRORATED, add_ev_load, calculate_bill, classify_tou_periods,
+    build_daily_tou_summary, calculate_bill_from_summary, slice_date_range, bill_statistics, summary_bill_statistics,
+    price_bill_from_statistics, tariff_cost_matrix
+)
+
+CUSTOMER_LABELS = {
+    "residential": "🏠 บ้านอยู่อาศัย", "smb_lv": "🏢 กิจการขนาดเล็ก (< 22 kV)", "smb_mv": "🏢 กิจการขนาดเล็ก (22-33 kV)",
+    "mb_lv": "🏭 กิจการขนาดกลาง (< 22 kV)", "mb_mv": "🏭 กิจการขนาดกลาง (22-33 kV)",
+}
+TARIFF_LABELS = {"normal": "📊 อัตราปกติ", "tou": "⏰ อัตรา TOU"}
 
 # ==============================================================================
 # --- Custom CSS Styling ---
@@ -224,240 +238,77 @@ def load_custom_css():
     </style>
     """, unsafe_allow_html=True)
 
-# ==============================================================================
-# --- ค่าคงที่และข้อมูลอัตรา (CONFIGURATIONS) ---
-# ==============================================================================
-
-# 1. อัตราค่าไฟฟ้า (Tariffs)
-TARIFFS = {
-    "residential": {
-        "normal": {
-            'service_charge_tiers': [
-                {'limit': 150, 'rate': 8.19},
-                {'limit': float('inf'), 'rate': 24.62}
-            ],
-            'type': 'tiered', 
-            'tiers': [
-                {'limit': 150, 'rate': 3.2484}, 
-                {'limit': 400, 'rate': 4.2218}, 
-                {'limit': float('inf'), 'rate': 4.4217}
-            ]
-        },
-        "tou": {'service_charge': 24.62, 'type': 'tou', 'peak_rate': 5.7982, 'off_peak_rate': 2.6369}
-    },
-    "smb_lv": { # กิจการขนาดเล็ก, แรงดันต่ำกว่า 22 kV
-        "normal": {'service_charge': 46.16, 'type': 'tiered', 'tiers': [{'limit': 150, 'rate': 3.2484}, {'limit': 400, 'rate': 4.2218}, {'limit': float('inf'), 'rate': 4.4217}]},
-        "tou": {'service_charge': 46.16, 'type': 'tou', 'peak_rate': 5.7982, 'off_peak_rate': 2.6369}
-    },
-    "smb_mv": { # กิจการขนาดเล็ก, แรงดัน 22-33 kV
-        "normal": {'service_charge': 312.24, 'type': 'flat', 'rate': 4.3168},
-        "tou": {'service_charge': 312.24, 'type': 'tou', 'peak_rate': 4.8773, 'off_peak_rate': 2.6549}
-    }
-}
-
-# 2. อัตราค่า Ft (Fuel Adjustment Charge)
-FT_RATES = {
-    (2023, 1): 0.9343, (2023, 5): 0.9119, (2023, 9): 0.2048,
-    (2024, 1): 0.3972, (2024, 5): 0.3972, (2024, 9): 0.3972,
-    (2025, 1): 0.3972, (2025, 5): 0.1972, (2025, 9): 0.1972,
-}
-
-# 3. วันหยุดสำหรับอัตรา TOU
-def get_all_offpeak_days(year, official_holidays_str):
-    offpeak_days = set()
-    for d_str in official_holidays_str:
-        try: offpeak_days.add(datetime.strptime(d_str, "%Y-%m-%d").date())
-        except ValueError: st.warning(f"รูปแบบวันที่ไม่ถูกต้องในรายการวันหยุด: {d_str}")
-    for month in range(1, 13):
-        cal = calendar.monthcalendar(year, month)
-        for week in cal:
-            saturday, sunday = week[calendar.SATURDAY], week[calendar.SUNDAY]
-            if saturday != 0: offpeak_days.add(date(year, month, saturday))
-            if sunday != 0: offpeak_days.add(date(year, month, sunday))
-    return offpeak_days
-
-HOLIDAYS_TOU_2024_STR = ["2024-01-01", "2024-02-12", "2024-02-24", "2024-02-26", "2024-04-06", "2024-04-08", "2024-04-13", "2024-04-14", "2024-04-15", "2024-04-16", "2024-05-01", "2024-05-04", "2024-05-06", "2024-05-22", "2024-06-03", "2024-07-20", "2024-07-21", "2024-07-22", "2024-07-28", "2024-07-29", "2024-08-12", "2024-10-13", "2024-10-14", "2024-10-23", "2024-12-05", "2024-12-10", "2024-12-31"]
-HOLIDAYS_TOU_2025_STR = ["2025-01-01", "2025-02-12", "2025-02-26", "2025-04-07", "2025-04-14", "2025-04-15", "2025-05-01", "2025-05-05", "2025-06-03", "2025-07-10", "2025-07-11", "2025-07-28", "2025-08-12", "2025-10-13", "2025-10-23", "2025-12-05", "2025-12-08", "2025-12-10", "2025-12-29", "2025-12-31"]
-HOLIDAYS_TOU_DATA = {2024: get_all_offpeak_days(2024, HOLIDAYS_TOU_2024_STR), 2025: get_all_offpeak_days(2025, HOLIDAYS_TOU_2025_STR)}
-
-# 4. ค่าคงที่อื่นๆ
-VAT_RATE = 0.07; PEAK_START = time(9, 0, 0); PEAK_END = time(21, 59, 59)
-
-# ==============================================================================
-# --- ฟังก์ชัน Helper ---
-# ==============================================================================
-@st.cache_data(show_spinner=False)
-def parse_data_file(uploaded_file, file_type):
-    if uploaded_file is None: return None
-    
-    df = None
-
-    try:
-        if file_type in ['BLE-iMeter', 'IPG']:
-            file_content_string = ""
-            encodings_to_try = ['utf-8', 'cp874', 'tis-620']
-            for enc in encodings_to_try:
-                try:
-                    uploaded_file.seek(0)
-                    file_content_string = uploaded_file.getvalue().decode(enc)
-                    break
-                except (UnicodeDecodeError, IndexError): continue
-            if not file_content_string: raise ValueError("ไม่สามารถอ่านไฟล์ได้ หรือไฟล์ว่างเปล่า")
-            data_io = io.StringIO(file_content_string)
-
-            if file_type == 'BLE-iMeter':
-                df_raw = pd.read_csv(data_io, sep=',', header=None, low_memory=False)
-                if df_raw.shape[1] < 4: raise ValueError(f"ไฟล์ BLE-iMeter CSV มี {df_raw.shape[1]} คอลัมน์ ไม่เพียงพอ")
-                df = pd.DataFrame({
-                    'DateTime': pd.to_datetime(df_raw.iloc[:, 1], errors='coerce'),
-                    'Total import kW demand': pd.to_numeric(df_raw.iloc[:, 3], errors='coerce') / 1000.0
-                })
-                st.success("✅ หน่วย Demand ในไฟล์ BLE-iMeter เป็น Watt (W), แปลงเป็น kW โดยการหาร 1000")
-            
-            elif file_type == 'IPG':
-                df_raw = pd.read_csv(data_io, sep='\t', header=0, skipinitialspace=True, low_memory=False)
-                df_raw.columns = df_raw.columns.str.strip()
-                if not all(col in df_raw.columns for col in ['DateTime', 'Total import kW demand']):
-                    raise ValueError("ไฟล์ IPG ต้องมีคอลัมน์: 'DateTime' และ 'Total import kW demand'")
-                def correct_buddhist_year(dt_str):
-                    try:
-                        parts = dt_str.split(' '); date_part = parts[0]; date_components = date_part.split('/')
-                        if len(date_components) == 3:
-                            day, month, year_be = map(int, date_components)
-                            year_ce = datetime.now().year if year_be < 1000 else year_be - 543
-                            return datetime(year_ce, month, day).strftime('%Y-%m-%d') + ' ' + parts[1]
-                    except Exception: return None
-                    return dt_str
-                df_raw['DateTime_Corrected'] = df_raw['DateTime'].apply(correct_buddhist_year)
-                df = pd.DataFrame({
-                    'DateTime': pd.to_datetime(df_raw['DateTime_Corrected'], errors='coerce'),
-                    'Total import kW demand': pd.to_numeric(df_raw['Total import kW demand'], errors='coerce')
-                })
-                st.success("✅ หน่วย Demand ในไฟล์ IPG เป็น Kilowatt (kW)")
-
-        elif file_type == 'มิเตอร์ PEA (CSV)':
-            uploaded_file.seek(0)
-            df_raw = pd.read_csv(uploaded_file, header=0, low_memory=False)
-            required_cols = ['DateTime', 'Total import kW demand']
-            if not all(col in df_raw.columns for col in required_cols):
-                raise ValueError(f"ไฟล์ CSV ต้องมีคอลัมน์ชื่อ '{required_cols[0]}' และ '{required_cols[1]}'")
-            df = pd.DataFrame({
-                'DateTime': pd.to_datetime(df_raw['DateTime'], dayfirst=True, errors='coerce'),
-                'Total import kW demand': pd.to_numeric(df_raw['Total import kW demand'], errors='coerce')
-            })
-            st.success("✅ สันนิษฐานว่าหน่วย Demand ในไฟล์ CSV เป็น Kilowatt (kW)")
-
-        if df is None:
-            raise ValueError(f"ประเภทไฟล์ '{file_type}' ไม่รองรับหรือไม่สามารถประมวลผลได้")
-
-        df_final = df.dropna(subset=['DateTime', 'Total import kW demand']).copy()
-        if df_final.empty: raise ValueError("ไม่พบข้อมูลที่ถูกต้องในไฟล์หลังการประมวลผล")
-        return df_final.sort_values(by='DateTime').reset_index(drop=True)
-
-    except Exception as e:
-        raise ValueError(f"เกิดข้อผิดพลาดขณะประมวลผลข้อมูล: {e}")
-
-def calculate_service_charge(total_kwh, rate_structure):
-    """คำนวณค่าบริการรายเดือนตาม tier ของหน่วยไฟที่ใช้"""
-    if 'service_charge_tiers' in rate_structure:
-        for tier in rate_structure['service_charge_tiers']:
-            if total_kwh <= tier['limit']:
-                return tier['rate']
-        return rate_structure['service_charge_tiers'][-1]['rate']
-    else:
-        return rate_structure['service_charge']
-
-def calculate_bill(df_processed, customer_type_key, tariff_type_key):
-    if df_processed is None or df_processed.empty: return {"error": "ไม่มีข้อมูลสำหรับคำนวณ"}
-    total_kwh = df_processed['kWh'].sum(); data_period_end_dt = df_processed['DateTime'].iloc[-1]; kwh_peak, kwh_off_peak = 0.0, 0.0
-    if tariff_type_key == 'tou':
-        df_processed['TOU_Period'] = df_processed['DateTime'].apply(classify_tou_period); kwh_summary = df_processed.groupby('TOU_Period')['kWh'].sum()
-        kwh_peak = kwh_summary.get('Peak', 0.0); kwh_off_peak = kwh_summary.get('Off-Peak', 0.0) + kwh_summary.get('Unknown', 0.0)
-    try:
-        rate_structure = TARIFFS[customer_type_key][tariff_type_key]
-    except KeyError as e: return {"error": f"ไม่พบโครงสร้างอัตราค่าไฟฟ้าสำหรับ '{customer_type_key}'/'{tariff_type_key}': {e}"}
-    
-    base_energy_cost = 0.0
-    if rate_structure['type'] == 'flat': base_energy_cost = total_kwh * rate_structure['rate']
-    elif rate_structure['type'] == 'tiered':
-        last_limit = 0
-        for tier in rate_structure['tiers']:
-            units_in_tier = max(0, min(total_kwh, tier['limit']) - last_limit); base_energy_cost += units_in_tier * tier['rate']; last_limit = tier['limit'];
-            if total_kwh <= tier['limit']: break
-    elif rate_structure['type'] == 'tou': base_energy_cost = (kwh_peak * rate_structure['peak_rate']) + (kwh_off_peak * rate_structure['off_peak_rate'])
-    
-    service_charge = calculate_service_charge(total_kwh, rate_structure)
-    applicable_ft_rate = get_ft_rate(data_period_end_dt); ft_cost = total_kwh * applicable_ft_rate
-    total_before_vat = base_energy_cost + service_charge + ft_cost; vat_amount = total_before_vat * VAT_RATE; final_bill = total_before_vat + vat_amount
-    
-    return {
-        "total_kwh": total_kwh, "final_bill": final_bill, "base_energy_cost": base_energy_cost,
-        "service_charge": service_charge, "ft_cost": ft_cost, "total_before_vat": total_before_vat,
-        "vat_amount": vat_amount, "applicable_ft_rate": applicable_ft_rate,
-        "kwh_peak": kwh_peak if tariff_type_key == 'tou' else None,
-        "kwh_off_peak": kwh_off_peak if tariff_type_key == 'tou' else None,
-        "data_period_start": df_processed['DateTime'].iloc[0].strftime('%Y-%m-%d %H:%M'),
-        "data_period_end": data_period_end_dt.strftime('%Y-%m-%d %H:%M'), "error": None
-    }
-
-def get_ft_rate(date_in_period):
-    d = date_in_period.date() if isinstance(date_in_period, datetime) else date_in_period
-    sorted_ft_periods = sorted(FT_RATES.keys(), reverse=True)
-    for start_year, start_month in sorted_ft_periods:
-        if d >= date(start_year, start_month, 1): return FT_RATES[(start_year, start_month)]
-    st.warning(f"ไม่พบอัตรา Ft สำหรับ {d}, ใช้ค่า Ft=0.0"); return 0.0
-
-def classify_tou_period(dt_obj):
-    if not isinstance(dt_obj, datetime): return 'Unknown'
-    current_date = dt_obj.date(); current_time = dt_obj.time()
-    year_holidays = HOLIDAYS_TOU_DATA.get(current_date.year)
-    if year_holidays is None:
-        if current_date.year not in st.session_state.get('missing_holiday_years', set()):
-            st.warning(f"ไม่พบข้อมูลวันหยุด TOU ปี {current_date.year}"); st.session_state.setdefault('missing_holiday_years', set()).add(current_date.year)
-        return 'Peak' if PEAK_START <= current_time <= PEAK_END else 'Off-Peak'
-    if current_date in year_holidays: return 'Off-Peak'
-    return 'Peak' if PEAK_START <= current_time <= PEAK_END else 'Off-Peak'
-
-def create_enhanced_chart_data(df_plot):
-    """เตรียมข้อมูลสำหรับกราฟ Streamlit"""
+def create_enhanced_chart_data(df_plot, zoom_range=None, max_points=CHART_MAX_POINTS, method=DOWNSAMPLE_MINMAX, pyramid=None):
+    """เตรียมข้อมูลสำหรับกราฟ Streamlit (ตัดตามช่วงวันที่ที่ซูม แล้วลดจำนวนจุดไม่เกิน max_points)
+    หากมี pyramid และช่วงที่ซูมมีข้อมูลเกิน max_points ใช้ระดับสรุปที่พอดีแทน (สูงสุด/เฉลี่ย/ต่ำสุด)"""
     if df_plot is None or df_plot.empty:
         return None
+    if zoom_range is not None:
+        df_plot = slice_date_range(df_plot, *zoom_range)
+        if df_plot.empty:
+            return None
+    
+    if pyramid is not None and method == DOWNSAMPLE_MINMAX and len(df_plot) > max_points:
+        _, level_data = select_pyramid_level(pyramid, df_plot['DateTime'].iloc[0], df_plot['DateTime'].iloc[-1] + pd.Timedelta(1), max_points)
+        return level_data[['kw_max', 'kw_mean', 'kw_min']].rename(columns={'kw_max': 'สูงสุด (kW)', 'kw_mean': 'เฉลี่ย (kW)', 'kw_min': 'ต่ำสุด (kW)'})
     
     # เตรียมข้อมูลสำหรับ line chart
-    chart_data = df_plot.set_index('DateTime')['Total import kW demand']
+    chart_data = downsample_series(df_plot['DateTime'], df_plot['Total import kW demand'], max_points, method)
     return chart_data
 
-def create_daily_consumption_data(df_plot):
+@st.cache_data(max_entries=32, show_spinner=False)
+def cached_chart_data(_df_plot, plot_key, zoom_range, max_points, method, _pyramid=None):
+    """create_enhanced_chart_data ที่แคชตามชุดข้อมูล (plot_key) ช่วงที่ซูม และจำนวนจุด"""
+    return create_enhanced_chart_data(_df_plot, zoom_range, max_points, method, _pyramid)
+
+def create_daily_consumption_data(df_plot, pyramid=None):
     """สร้างข้อมูลการใช้ไฟรายวัน"""
     if df_plot is None or df_plot.empty:
         return None
     
+    if pyramid is not None:
+        daily_data = pyramid['1D']['kw_mean']
+        return daily_data.set_axis(daily_data.index.date)
     daily_data = df_plot.groupby(df_plot['DateTime'].dt.date)['Total import kW demand'].mean()
     return daily_data
 
-def create_hourly_pattern_data(df_plot):
+def create_hourly_pattern_data(df_plot, pyramid=None):
     """สร้างข้อมูลรูปแบบการใช้ไฟตามชั่วโมง"""
     if df_plot is None or df_plot.empty:
         return None
     
-    df_plot['Hour'] = df_plot['DateTime'].dt.hour
-    hourly_data = df_plot.groupby('Hour')['Total import kW demand'].mean()
+    if pyramid is not None:
+        hourly_level = pyramid['1h']; hour = pd.Index(hourly_level.index.hour.astype(HOUR_DTYPE), name='Hour')
+        return (hourly_level['kw_sum'].groupby(hour).sum() / hourly_level['rows'].groupby(hour).sum()).rename('Total import kW demand')
+    hourly_data = df_plot['Total import kW demand'].groupby(df_plot['DateTime'].dt.hour.astype(HOUR_DTYPE).rename('Hour')).mean()
     return hourly_data
 
-def generate_print_report(bill_data, ev_data, df_plot, settings):
+def create_tou_summary_data(df_plot, pyramid=None):
+    """สรุป kW เฉลี่ย/รวม/จำนวนข้อมูลแยก Peak/Off-Peak"""
+    if df_plot is None or df_plot.empty:
+        return None
+    
+    if pyramid is not None:
+        totals = pyramid['1W'][['kw_sum', 'rows', 'kw_sum_peak', 'rows_peak']].sum()
+        tou_summary = pd.DataFrame(
+            {'sum': [totals['kw_sum'] - totals['kw_sum_peak'], totals['kw_sum_peak']], 'count': [totals['rows'] - totals['rows_peak'], totals['rows_peak']]},
+            index=pd.Index(['Off-Peak', 'Peak'], name='TOU_Period')
+        )
+        tou_summary = tou_summary[tou_summary['count'] > 0]
+        tou_summary.insert(0, 'mean', tou_summary['sum'] / tou_summary['count'])
+        return tou_summary
+    return df_plot['Total import kW demand'].groupby(classify_tou_periods(df_plot['DateTime']), observed=True).agg(['mean', 'sum', 'count'])
+
+def demand_stats(df):
+    """สถิติ Demand ของ DataFrame จากการอ่านรอบเดียว (ใช้ร่วมกันใน Sidebar, สถิติการใช้ไฟ และรายงาน)"""
+    return DemandStats.from_series(df['Total import kW demand']).as_dict()
+
+def generate_print_report(bill_data, ev_data, df_plot, settings, stats=None):
     """สร้างรายงานสำหรับพิมพ์ในรูปแบบ HTML"""
     
-    # คำนวณสถิติเพิ่มเติม
+    # คำนวณสถิติเพิ่มเติม (ใช้ stats ที่คำนวณไว้แล้วถ้ามี)
     if df_plot is not None and not df_plot.empty:
-        stats = {
-            'max_demand': df_plot['Total import kW demand'].max(),
-            'min_demand': df_plot['Total import kW demand'].min(),
-            'avg_demand': df_plot['Total import kW demand'].mean(),
-            'median_demand': df_plot['Total import kW demand'].median(),
-            'std_demand': df_plot['Total import kW demand'].std(),
-            'load_factor': (df_plot['Total import kW demand'].mean() / df_plot['Total import kW demand'].max()) * 100,
-            'total_records': len(df_plot)
-        }
+        stats = stats or demand_stats(df_plot)
     else:
         stats = {}
     
@@ -748,6 +599,7 @@ def generate_print_report(bill_data, ev_data, df_plot, settings):
     # เพิ่มรายการคำนวณ
     calculation_items = [
         ("ค่าพลังงานไฟฟ้า", bill_data['base_energy_cost']),
+        *([(f"ค่าความต้องการพลังไฟฟ้า ({bill_data['demand_kw']:,.2f} kW)", bill_data['demand_charge'])] if bill_data.get('demand_kw') is not None else []),
         ("ค่าบริการรายเดือน", bill_data['service_charge']),
         (f"ค่า Ft (@{bill_data['applicable_ft_rate']:.4f})", bill_data['ft_cost']),
         ("รวมก่อน VAT", bill_data['total_before_vat']),
@@ -879,7 +731,7 @@ st.set_page_config(
 load_custom_css()
 
 # Initialize session state
-for key in ['full_dataframe', 'last_uploaded_filename', 'calculation_result', 'ev_cost', 'base_kwh', 'ev_kwh']:
+for key in ['dataset', 'daily_summary', 'last_uploaded_filename', 'calculation_result', 'ev_cost', 'base_kwh', 'ev_kwh', 'ev_sweep_result', 'cycle_bills', 'plot_key', 'plot_pyramid', 'full_stats', 'plot_stats']:
     if key not in st.session_state: st.session_state[key] = None
 
 # Header
@@ -895,13 +747,15 @@ with st.sidebar:
     st.markdown("### 🔧 เครื่องมือและข้อมูล")
     
     # Quick Stats
-    if st.session_state.get('full_dataframe') is not None:
-        df_info = st.session_state.full_dataframe
+    if st.session_state.get('dataset') is not None:
+        df_info = st.session_state.dataset.data
+        if st.session_state.get('full_stats') is None: st.session_state.full_stats = demand_stats(df_info)
+        info_stats = st.session_state.full_stats
         st.markdown("### 📈 ข้อมูลไฟล์")
-        st.metric("จำนวนข้อมูล", f"{len(df_info):,} รายการ")
-        st.metric("ช่วงเวลา", f"{(df_info['DateTime'].max() - df_info['DateTime'].min()).days} วัน")
-        st.metric("Demand เฉลี่ย", f"{df_info['Total import kW demand'].mean():.2f} kW")
-        st.metric("Demand สูงสุด", f"{df_info['Total import kW demand'].max():.2f} kW")
+        st.metric("จำนวนข้อมูล", f"{info_stats['total_records']:,} รายการ")
+        st.metric("ช่วงเวลา", f"{(df_info['DateTime'].iloc[-1] - df_info['DateTime'].iloc[0]).days} วัน")
+        st.metric("Demand เฉลี่ย", f"{info_stats['avg_demand']:.2f} kW")
+        st.metric("Demand สูงสุด", f"{info_stats['max_demand']:.2f} kW")
     
     st.markdown("---")
     st.markdown("### 💡 คำแนะนำ")
@@ -922,11 +776,12 @@ col1, col2 = st.columns([2, 3])
 with col1:
     selected_file_type_label = st.radio(
         "เลือกประเภทไฟล์ข้อมูล:",
-        ("📱 BLE-iMeter (.txt)", "🖥️ IPG (.txt)", "📊 มิเตอร์ PEA (CSV)"),
+        ("🔍 ตรวจจากไฟล์อัตโนมัติ", "📱 BLE-iMeter (.txt)", "🖥️ IPG (.txt)", "📊 มิเตอร์ PEA (CSV)"),
         key="data_file_type_label"
     )
 
 file_type_mapping = {
+    "🔍 ตรวจจากไฟล์อัตโนมัติ": FILE_TYPE_AUTO,
     "📱 BLE-iMeter (.txt)": "BLE-iMeter",
     "🖥️ IPG (.txt)": "IPG", 
     "📊 มิเตอร์ PEA (CSV)": "มิเตอร์ PEA (CSV)"
@@ -934,30 +789,44 @@ file_type_mapping = {
 internal_file_type = file_type_mapping[selected_file_type_label]
 
 with col2:
-    file_extension = 'csv' if internal_file_type == 'มิเตอร์ PEA (CSV)' else 'txt'
-    if internal_file_type == 'มิเตอร์ PEA (CSV)':
+    file_extensions = ['txt', 'csv'] if internal_file_type == FILE_TYPE_AUTO else ['csv'] if internal_file_type == 'มิเตอร์ PEA (CSV)' else ['txt']
+    if internal_file_type in (FILE_TYPE_AUTO, 'มิเตอร์ PEA (CSV)'):
         st.markdown('<div class="status-badge status-info">💡 สำหรับไฟล์ Excel (.xlsx) กรุณาบันทึกเป็น CSV ก่อน</div>', unsafe_allow_html=True)
     
     uploaded_file = st.file_uploader(
-        f"เลือกไฟล์ (.{file_extension})",
-        type=[file_extension],
+        f"เลือกไฟล์ ({', '.join('.' + ext for ext in file_extensions)})",
+        type=file_extensions,
         key="file_uploader",
-        help=f"อัปโหลดไฟล์ {internal_file_type} ของคุณ"
+        help="อัปโหลดไฟล์ BLE-iMeter, IPG หรือมิเตอร์ PEA (CSV) ของคุณ" if internal_file_type == FILE_TYPE_AUTO else f"อัปโหลดไฟล์ {internal_file_type} ของคุณ"
     )
 
 if uploaded_file and (uploaded_file.name != st.session_state.get('last_uploaded_filename') or internal_file_type != st.session_state.get('last_file_type')):
     with st.spinner('🔄 กำลังประมวลผลไฟล์...'):
         try:
-            st.session_state.full_dataframe = parse_data_file(uploaded_file, internal_file_type)
+            # ตรวจประเภทไฟล์จากต้นไฟล์เท่านั้น แล้วอ่านทั้งไฟล์ครั้งเดียวตอนแปลงข้อมูล
+            file_type = detected_file_type(sniff_meter_file(uploaded_file)) if internal_file_type == FILE_TYPE_AUTO else internal_file_type
+            # session เก็บเพียง handle ข้อมูลอยู่ใน DATASET_REGISTRY ร่วมกับ session อื่นที่เปิดไฟล์เดียวกัน
+            dataset_key = parsed_cache_key(uploaded_file, file_type)
+            dataset = DATASET_REGISTRY.acquire(dataset_key, lambda: load_meter_data(uploaded_file, file_type, dataset_key))
+            if st.session_state.get('dataset') is not None: st.session_state.dataset.release()
+            st.session_state.dataset = dataset
+            st.session_state.daily_summary = build_daily_tou_summary(dataset.data)
+            st.session_state.full_stats = demand_stats(dataset.data)
+            st.session_state.ev_sweep_result = None
+            if internal_file_type == FILE_TYPE_AUTO: st.info(f"🔍 ตรวจพบไฟล์ประเภท {file_type}")
+            st.success(DEMAND_UNIT_NOTES[file_type])
             st.session_state.last_uploaded_filename = uploaded_file.name
             st.session_state.last_file_type = internal_file_type
             st.balloons()
             st.success(f"✅ ประมวลผลไฟล์ '{uploaded_file.name}' สำเร็จ!")
         except ValueError as ve:
             st.error(f"❌ ข้อผิดพลาด: {ve}")
-            st.session_state.full_dataframe = None
+            if st.session_state.get('dataset') is not None: st.session_state.dataset.release()
+            st.session_state.dataset = None
+            st.session_state.daily_summary = None
+            st.session_state.full_stats = None
 
-if st.session_state.get('full_dataframe') is not None:
+if st.session_state.get('dataset') is not None:
     # Section 2: Configuration
     st.markdown("""
     <div class="section-card">
@@ -968,27 +837,30 @@ if st.session_state.get('full_dataframe') is not None:
     </div>
     """, unsafe_allow_html=True)
     
-    df_full = st.session_state.full_dataframe
-    min_date = df_full['DateTime'].min().date()
-    max_date = df_full['DateTime'].max().date()
+    df_full = st.session_state.dataset.data
+    if st.session_state.get('daily_summary') is None:
+        st.session_state.daily_summary = build_daily_tou_summary(df_full)
+    min_date = df_full['DateTime'].iloc[0].date()
+    max_date = df_full['DateTime'].iloc[-1].date()
     
     col1, col2 = st.columns([1, 2])
     with col1:
         st.markdown("#### 👤 ประเภทผู้ใช้")
         customer_label = st.selectbox(
             "เลือกประเภท:",
-            ["🏠 บ้านอยู่อาศัย", "🏢 กิจการขนาดเล็ก"],
+            ["🏠 บ้านอยู่อาศัย", "🏢 กิจการขนาดเล็ก", "🏭 กิจการขนาดกลาง"],
             key="customer_type_label"
         )
         
         customer_key = "residential"
-        if customer_label == "🏢 กิจการขนาดเล็ก":
+        if customer_label != "🏠 บ้านอยู่อาศัย":
             voltage_label = st.radio(
                 "ระดับแรงดันไฟฟ้า:",
                 ("⚡ แรงดันต่ำกว่า 22 kV", "⚡⚡ แรงดัน 22-33 kV"),
                 key="voltage_level"
             )
-            customer_key = "smb_lv" if voltage_label == "⚡ แรงดันต่ำกว่า 22 kV" else "smb_mv"
+            customer_key = ("smb" if customer_label == "🏢 กิจการขนาดเล็ก" else "mb") + ("_lv" if voltage_label == "⚡ แรงดันต่ำกว่า 22 kV" else "_mv")
+            if customer_key.startswith("mb"): st.caption("คิดค่าความต้องการพลังไฟฟ้าจาก Demand เฉลี่ย 15 นาทีสูงสุดของแต่ละเดือน (อัตรา TOU นับเฉพาะช่วง Peak)")
         
         st.markdown("#### 💰 ประเภทอัตรา")
         tariff_type = st.selectbox(
@@ -996,6 +868,38 @@ if st.session_state.get('full_dataframe') is not None:
             ["📊 อัตราปกติ", "⏰ อัตรา TOU"],
             key="tariff_type"
         )
+        ft_prorated = st.checkbox(
+            "📆 คิดค่า Ft ตามงวดของแต่ละช่วงเวลา",
+            key="ft_prorated",
+            help="ใช้อัตรา Ft ที่มีผล ณ เวลาของข้อมูลแต่ละแถว เหมาะกับช่วงวันที่ที่คร่อมหลายงวด Ft"
+        )
+        ft_mode = FT_MODE_PRORATED if ft_prorated else FT_MODE_PERIOD_END
+        energy_method_options = {
+            "📏 ช่วงเวลาคงที่ (จากสองแถวแรก)": ENERGY_METHOD_FIXED,
+            "⏱️ ตามช่วงเวลาจริง (Left Riemann)": ENERGY_METHOD_LEFT,
+            "📐 ตามช่วงเวลาจริง (Trapezoidal)": ENERGY_METHOD_TRAPEZOID,
+        }
+        energy_method_label = st.selectbox(
+            "🔢 วิธีคำนวณหน่วยไฟ (kWh):",
+            list(energy_method_options),
+            key="energy_method",
+            help="ตามช่วงเวลาจริง: เหมาะกับมิเตอร์ที่ข้อมูลขาดหาย เปลี่ยนช่วงบันทึกกลางไฟล์ หรือมีเวลาซ้ำ"
+        )
+        energy_method = energy_method_options[energy_method_label]
+        cycle_billing = st.checkbox(
+            "📆 แยกบิลตามรอบจดมิเตอร์รายเดือน",
+            key="cycle_billing",
+            help="คิดขั้นอัตรา ค่าบริการ และค่า Ft แยกแต่ละรอบบิล เหมาะกับข้อมูลที่ยาวกว่าหนึ่งเดือน"
+        )
+        meter_read_day = st.number_input(
+            "📍 วันที่จดมิเตอร์:",
+            min_value=1,
+            max_value=31,
+            value=1,
+            key="meter_read_day",
+            disabled=not cycle_billing,
+            help="รอบบิลเริ่มวันที่นี้ของทุกเดือน (เดือนที่สั้นกว่าใช้วันสุดท้ายของเดือน)"
+        )
         
     with col2:
         st.markdown("#### 📅 ช่วงวันที่คำนวณ")
@@ -1013,6 +917,12 @@ if st.session_state.get('full_dataframe') is not None:
         st.markdown("### ⚡ การตั้งค่า Electric Vehicle Charging")
         
         ev_enabled = st.checkbox("🔌 เปิดใช้งานการจำลอง EV Charger", key="ev_enabled")
+        ev_smart = st.checkbox(
+            "🧠 จัดเวลาชาร์จอัตโนมัติให้ค่าไฟต่ำที่สุด",
+            key="ev_smart",
+            disabled=not ev_enabled,
+            help="ใช้เวลาเริ่ม/สิ้นสุดเป็นช่วงที่เสียบสายชาร์จ แล้วชาร์จในช่วงที่ค่าไฟถูกที่สุดจนได้พลังงานที่ต้องการ (อัตราที่มีค่า Demand จะเกลี่ยกำลังไฟชาร์จในช่วงที่นับ Demand ให้เท่ากัน)"
+        )
         
         col_ev1, col_ev2 = st.columns(2)
         with col_ev1:
@@ -1036,6 +946,16 @@ if st.session_state.get('full_dataframe') is not None:
                 disabled=not ev_enabled,
                 help="กำลังไฟของเครื่องชาร์จ EV"
             )
+            
+            ev_energy_kwh = st.number_input(
+                "🔋 พลังงานที่ต้องการต่อวัน (kWh):",
+                min_value=0.1,
+                value=20.0,
+                step=1.0,
+                key="ev_energy_kwh",
+                disabled=not (ev_enabled and ev_smart),
+                help="พลังงานที่ต้องชาร์จให้ได้ในแต่ละครั้งที่เสียบสายชาร์จ (ใช้กับการจัดเวลาชาร์จอัตโนมัติ)"
+            )
         
         with col_ev2:
             ev_start_time = st.time_input(
@@ -1064,7 +984,44 @@ if st.session_state.get('full_dataframe') is not None:
             col_preview1, col_preview2, col_preview3 = st.columns(3)
             col_preview1.metric("🔋 กำลังชาร์จ", f"{ev_power_kw} kW")
             col_preview2.metric("⏱️ ชั่วโมงต่อวัน", f"{ev_hours:.1f} ชม.")
-            col_preview3.metric("📊 พลังงานต่อวัน", f"{ev_power_kw * ev_hours:.1f} kWh")
+            col_preview3.metric("📊 พลังงานต่อวัน", f"{min(ev_energy_kwh, ev_power_kw * ev_hours) if ev_smart else ev_power_kw * ev_hours:.1f} kWh")
+            
+            # Scenario sweep
+            st.markdown("### 🔍 เปรียบเทียบหลายสถานการณ์ชาร์จ")
+            col_sweep1, col_sweep2 = st.columns(2)
+            ev_sweep_powers = col_sweep1.text_input(
+                "⚡ กำลังไฟ Charger หลายค่า (kW):", "3.7, 7.4, 11", key="ev_sweep_powers",
+                help="คั่นแต่ละค่าด้วยเครื่องหมายจุลภาค"
+            )
+            ev_sweep_windows = col_sweep2.text_input(
+                "🕒 ช่วงเวลาชาร์จหลายช่วง:", "22:00-05:00, 00:00-06:00, 09:00-16:00", key="ev_sweep_windows",
+                help="รูปแบบ HH:MM-HH:MM คั่นแต่ละช่วงด้วยเครื่องหมายจุลภาค"
+            )
+            if st.button("🔍 จัดอันดับสถานการณ์ชาร์จ", key="ev_sweep_button"):
+                try:
+                    sweep_powers = [float(v) for v in ev_sweep_powers.split(',') if v.strip()]
+                    sweep_windows = [tuple(datetime.strptime(part.strip(), '%H:%M').time() for part in w.split('-')) for w in ev_sweep_windows.split(',') if w.strip()]
+                    if not sweep_powers or not sweep_windows or any(len(w) != 2 for w in sweep_windows): raise ValueError("กรุณาระบุกำลังไฟและช่วงเวลาอย่างน้อยหนึ่งค่า")
+                    if len(main_date_range) != 2: raise ValueError("กรุณาเลือกวันเริ่มต้นและวันสิ้นสุด")
+                    df_sweep = slice_date_range(df_full, *main_date_range)
+                    tariff_key_str = "tou" if tariff_type == "⏰ อัตรา TOU" else "normal"
+                    st.session_state.ev_sweep_result = sweep_ev_scenarios(
+                        df_sweep, customer_key, tariff_key_str, sweep_powers, sweep_windows,
+                        [tuple(st.session_state.ev_date_range)], ft_mode, energy_method
+                    )
+                except Exception as e:
+                    st.session_state.ev_sweep_result = None
+                    st.error(f"❌ ไม่สามารถจำลองหลายสถานการณ์ได้: {e}")
+            if st.session_state.get('ev_sweep_result') is not None:
+                sweep_table = st.session_state.ev_sweep_result
+                st.dataframe(
+                    sweep_table[['rank', 'ev_power_kw', 'ev_start_time', 'ev_end_time', 'ev_kwh', 'ev_kwh_peak', 'ev_cost', 'ev_cost_per_kwh', 'final_bill']].rename(columns={
+                        'rank': 'อันดับ', 'ev_power_kw': 'กำลังไฟ (kW)', 'ev_start_time': 'เริ่มชาร์จ', 'ev_end_time': 'สิ้นสุด',
+                        'ev_kwh': 'หน่วยไฟ EV (kWh)', 'ev_kwh_peak': 'EV ช่วง Peak (kWh)', 'ev_cost': 'ค่าไฟ EV (บาท)',
+                        'ev_cost_per_kwh': 'บาท/kWh', 'final_bill': 'ค่าไฟรวม (บาท)'
+                    }),
+                    hide_index=True, use_container_width=True
+                )
 
     st.markdown("<br>", unsafe_allow_html=True)
     
@@ -1086,6 +1043,7 @@ if st.session_state.get('full_dataframe') is not None:
         st.session_state.ev_cost = None
         st.session_state.base_kwh = None
         st.session_state.ev_kwh = None
+        st.session_state.cycle_bills = None
         
         if len(main_date_range) != 2:
             st.error("❌ กรุณาเลือกวันเริ่มต้นและวันสิ้นสุด")
@@ -1093,40 +1051,54 @@ if st.session_state.get('full_dataframe') is not None:
             main_start_date, main_end_date = main_date_range
             with st.spinner("🔄 กำลังคำนวณ..."):
                 try:
-                    mask = (df_full['DateTime'].dt.date >= main_start_date) & (df_full['DateTime'].dt.date <= main_end_date)
-                    df_filtered = df_full[mask].copy()
+                    df_filtered = slice_date_range(df_full, main_start_date, main_end_date)
                     if df_filtered.empty:
                         st.warning("⚠️ ไม่พบข้อมูลในช่วงวันที่ที่เลือก")
                     else:
                         tariff_key_str = "tou" if tariff_type == "⏰ อัตรา TOU" else "normal"
-                        interval_hours = (df_filtered['DateTime'].iloc[1] - df_filtered['DateTime'].iloc[0]).total_seconds() / 3600.0 if len(df_filtered) > 1 else 0.25
-                        if not (0 < interval_hours <= 24): interval_hours = 0.25
                         
-                        df_base = df_filtered.copy()
-                        df_base['kWh'] = df_base['Total import kW demand'] * interval_hours
-                        base_bill_details = calculate_bill(df_base, customer_key, tariff_key_str)
+                        df_base = df_filtered.copy(deep=False)
+                        base_kwh, gap_stats = compute_kwh(df_base, energy_method)
+                        df_base['kWh'] = base_kwh
+                        if energy_method == ENERGY_METHOD_FIXED:
+                            base_bill_details = calculate_bill_from_summary(st.session_state.daily_summary, main_start_date, main_end_date, customer_key, tariff_key_str, ft_mode)
+                        else:
+                            base_bill_details = calculate_bill(df_base, customer_key, tariff_key_str, ft_mode)
                         st.session_state.base_kwh = base_bill_details['total_kwh']
                         
                         total_bill_details = base_bill_details
                         
                         if ev_enabled:
-                            df_with_ev = df_filtered.copy()
-                            time_series = df_with_ev['DateTime'].dt.time
-                            date_series = df_with_ev['DateTime'].dt.date
                             ev_start_date_select, ev_end_date_select = st.session_state.ev_date_range
-                            time_mask = (time_series >= ev_start_time) | (time_series < ev_end_time) if ev_start_time > ev_end_time else (time_series >= ev_start_time) & (time_series < ev_end_time)
-                            date_mask = (date_series >= ev_start_date_select) & (date_series <= ev_end_date_select)
-                            df_with_ev.loc[time_mask & date_mask, 'Total import kW demand'] += ev_power_kw
+                            if ev_smart:
+                                df_with_ev, ev_schedule = schedule_ev_charging(df_filtered, customer_key, tariff_key_str, ev_energy_kwh, ev_power_kw, ev_start_time, ev_end_time, ev_start_date_select, ev_end_date_select, ft_mode, energy_method)
+                                if ev_schedule['short_sessions']:
+                                    st.warning(f"⚠️ ชาร์จไม่ครบ {ev_schedule['short_sessions']:,} ครั้ง ขาดรวม {ev_schedule['shortfall_kwh']:,.1f} kWh (กำลังไฟหรือช่วงเวลาเสียบชาร์จไม่พอ)")
+                            else:
+                                df_with_ev = add_ev_load(df_filtered, ev_power_kw, ev_start_time, ev_end_time, ev_start_date_select, ev_end_date_select)
                             
-                            df_with_ev['kWh'] = df_with_ev['Total import kW demand'] * interval_hours
-                            total_bill_details = calculate_bill(df_with_ev, customer_key, tariff_key_str)
+                            df_with_ev['kWh'] = compute_kwh(df_with_ev, energy_method)[0]
+                            total_bill_details = calculate_bill(df_with_ev, customer_key, tariff_key_str, ft_mode)
                             
                             st.session_state.ev_cost = total_bill_details['final_bill'] - base_bill_details['final_bill']
                             st.session_state.ev_kwh = total_bill_details['total_kwh'] - base_bill_details['total_kwh']
-                            st.session_state.df_for_plotting = df_with_ev
+                            df_result = df_with_ev
                         else:
-                            st.session_state.df_for_plotting = df_base
+                            df_result = df_base
+                        # เก็บเฉพาะ DateTime/Demand แบบ float32 ไว้ใน session ส่วนที่ต้องใช้ kWh สรุปไว้ใน pyramid/รอบบิลแล้ว
+                        st.session_state.df_for_plotting = compact_meter_frame(df_result)
+                        st.session_state.plot_key = uuid.uuid4().hex
+                        st.session_state.plot_pyramid = build_load_pyramid(df_result)
+                        st.session_state.plot_stats = demand_stats(df_result)
                         
+                        for message in total_bill_details.get('warnings', []): st.warning(f"⚠️ {message}")
+                        if cycle_billing:
+                            cycle_bills, cycle_warnings = calculate_cycle_bills(df_result, customer_key, tariff_key_str, meter_read_day, ft_mode)
+                            for message in cycle_warnings:
+                                if message not in total_bill_details.get('warnings', []): st.warning(f"⚠️ {message}")
+                            st.session_state.cycle_bills = cycle_bills
+                        gap_note = format_gap_stats(gap_stats)
+                        if gap_note: st.info(f"ℹ️ {gap_note}")
                         st.session_state.calculation_result = total_bill_details
                         st.session_state.do_calculation = False
                         st.success("✅ คำนวณเสร็จสิ้น!")
@@ -1141,6 +1113,7 @@ if st.session_state.get('full_dataframe') is not None:
         st.session_state.ev_cost = None
         st.session_state.base_kwh = None
         st.session_state.ev_kwh = None
+        st.session_state.cycle_bills = None
         
         if len(main_date_range) != 2:
             st.error("❌ กรุณาเลือกวันเริ่มต้นและวันสิ้นสุด")
@@ -1148,28 +1121,40 @@ if st.session_state.get('full_dataframe') is not None:
             main_start_date, main_end_date = main_date_range
             with st.spinner("🔄 กำลังเปรียบเทียบอัตราค่าไฟ..."):
                 try:
-                    mask = (df_full['DateTime'].dt.date >= main_start_date) & (df_full['DateTime'].dt.date <= main_end_date)
-                    df_filtered = df_full[mask].copy()
-                    if df_filtered.empty:
+                    normal_bill = tou_bill = statistics = None
+                    if ev_enabled or energy_method != ENERGY_METHOD_FIXED:
+                        df_filtered = slice_date_range(df_full, main_start_date, main_end_date)
+                        if not df_filtered.empty:
+                            if ev_enabled and ev_smart:
+                                # ตารางชาร์จที่ถูกที่สุดขึ้นกับอัตรา จึงจัดแยกกันสำหรับแต่ละอัตรา
+                                ev_start_date_select, ev_end_date_select = st.session_state.ev_date_range
+                                df_normal, df_tou = (
+                                    schedule_ev_charging(df_filtered, customer_key, tariff_key, ev_energy_kwh, ev_power_kw, ev_start_time, ev_end_time, ev_start_date_select, ev_end_date_select, ft_mode, energy_method)[0]
+                                    for tariff_key in ("normal", "tou")
+                                )
+                                normal_bill = calculate_bill(df_normal, customer_key, "normal", ft_mode)
+                                tou_bill = calculate_bill(df_tou, customer_key, "tou", ft_mode)
+                            else:
+                                if ev_enabled:
+                                    ev_start_date_select, ev_end_date_select = st.session_state.ev_date_range
+                                    df_compare = add_ev_load(df_filtered, ev_power_kw, ev_start_time, ev_end_time, ev_start_date_select, ev_end_date_select)
+                                else:
+                                    df_compare = df_filtered.copy(deep=False)
+                                df_compare['kWh'] = compute_kwh(df_compare, energy_method)[0]
+                                statistics = bill_statistics(df_compare, ft_mode)
+                    else:
+                        # ไม่มี EV: คิดจากตารางสรุปรายวันโดยไม่ต้องสแกนข้อมูลดิบ
+                        statistics = summary_bill_statistics(st.session_state.daily_summary, main_start_date, main_end_date, ft_mode)
+                    # สแกนข้อมูลครั้งเดียวแล้วคิดทุกอัตราจากสถิติชุดเดียวกัน
+                    tariff_matrix = None
+                    if statistics is not None and not statistics.get('error'):
+                        normal_bill, tou_bill = (price_bill_from_statistics(statistics, customer_key, tariff_key) for tariff_key in ("normal", "tou"))
+                        tariff_matrix = tariff_cost_matrix(statistics)
+                    
+                    if normal_bill is None:
                         st.warning("⚠️ ไม่พบข้อมูลในช่วงวันที่ที่เลือก")
                     else:
-                        interval_hours = (df_filtered['DateTime'].iloc[1] - df_filtered['DateTime'].iloc[0]).total_seconds() / 3600.0 if len(df_filtered) > 1 else 0.25
-                        if not (0 < interval_hours <= 24): interval_hours = 0.25
-                        
-                        df_base = df_filtered.copy()
-                        df_base['kWh'] = df_base['Total import kW demand'] * interval_hours
-                        
-                        if ev_enabled:
-                            time_series = df_base['DateTime'].dt.time
-                            date_series = df_base['DateTime'].dt.date
-                            ev_start_date_select, ev_end_date_select = st.session_state.ev_date_range
-                            time_mask = (time_series >= ev_start_time) | (time_series < ev_end_time) if ev_start_time > ev_end_time else (time_series >= ev_start_time) & (time_series < ev_end_time)
-                            date_mask = (date_series >= ev_start_date_select) & (date_series <= ev_end_date_select)
-                            df_base.loc[time_mask & date_mask, 'Total import kW demand'] += ev_power_kw
-                            df_base['kWh'] = df_base['Total import kW demand'] * interval_hours
-                        
-                        normal_bill = calculate_bill(df_base, customer_key, "normal")
-                        tou_bill = calculate_bill(df_base, customer_key, "tou")
+                        for message in dict.fromkeys(normal_bill.get('warnings', []) + tou_bill.get('warnings', [])): st.warning(f"⚠️ {message}")
                         
                         # Display Comparison Results
                         st.markdown("""
@@ -1259,6 +1244,10 @@ if st.session_state.get('full_dataframe') is not None:
                                     f"{tou_bill['final_bill'] - normal_bill['final_bill']:+,.2f}"
                                 ]
                             }
+                            if normal_bill.get('demand_kw') is not None:
+                                for column, values in comparison_data.items():
+                                    values.insert(1, "ค่าความต้องการพลังไฟฟ้า (บาท)" if column == "รายการ" else f"{tou_bill['demand_charge'] - normal_bill['demand_charge']:+,.2f}" if column == "💡 ผลต่าง"
+                                                  else f"{(normal_bill if column == '📊 อัตราปกติ' else tou_bill)['demand_charge']:,.2f}")
                             comparison_df = pd.DataFrame(comparison_data)
                             st.dataframe(comparison_df, use_container_width=True, hide_index=True)
                             
@@ -1273,6 +1262,21 @@ if st.session_state.get('full_dataframe') is not None:
                             else:
                                 st.error("❌ **อัตราปกติประหยัดกว่า** - ไม่แนะนำให้เปลี่ยนเป็น TOU เนื่องจากใช้ไฟใน Peak มาก")
                         
+                        if tariff_matrix is not None and not tariff_matrix.empty:
+                            with st.expander("🧮 ค่าไฟทุกประเภทผู้ใช้และอัตรา", expanded=False):
+                                cheapest = tariff_matrix.iloc[0]
+                                st.info(f"💡 ถูกที่สุด: {CUSTOMER_LABELS.get(cheapest['customer_type'], cheapest['customer_type'])} - {TARIFF_LABELS.get(cheapest['tariff_type'], cheapest['tariff_type'])} ({cheapest['final_bill']:,.2f} บาท)")
+                                st.dataframe(
+                                    tariff_matrix.assign(
+                                        customer_type=tariff_matrix['customer_type'].map(lambda key: CUSTOMER_LABELS.get(key, key)),
+                                        tariff_type=tariff_matrix['tariff_type'].map(lambda key: TARIFF_LABELS.get(key, key))
+                                    )[['rank', 'customer_type', 'tariff_type', 'base_energy_cost', 'demand_charge', 'service_charge', 'ft_cost', 'vat_amount', 'final_bill']].rename(columns={
+                                        'rank': 'อันดับ', 'customer_type': 'ประเภทผู้ใช้', 'tariff_type': 'อัตรา', 'base_energy_cost': 'ค่าพลังงาน',
+                                        'demand_charge': 'ค่าความต้องการพลังไฟฟ้า', 'service_charge': 'ค่าบริการ', 'ft_cost': 'ค่า Ft', 'vat_amount': 'VAT', 'final_bill': 'ค่าไฟสุทธิ (บาท)'
+                                    }),
+                                    hide_index=True, use_container_width=True
+                                )
+                        
                         st.session_state.do_comparison = False
                         
                 except Exception as e:
@@ -1360,10 +1364,23 @@ if st.session_state.calculation_result:
                 </div>
                 """.format(bill['applicable_ft_rate']), unsafe_allow_html=True)
 
+        # Billing cycles
+        cycle_bills = st.session_state.get('cycle_bills')
+        if cycle_bills is not None:
+            with st.expander(f"📆 บิลแยกตามรอบจดมิเตอร์ ({len(cycle_bills):,} รอบ รวม {cycle_bills['final_bill'].sum():,.2f} บาท)", expanded=True):
+                st.dataframe(
+                    cycle_bills[['cycle_start', 'cycle_end', 'total_kwh', 'kwh_peak', 'kwh_off_peak', 'demand_kw', 'base_energy_cost', 'demand_charge', 'service_charge', 'applicable_ft_rate', 'ft_cost', 'vat_amount', 'final_bill']].rename(columns={
+                        'cycle_start': 'เริ่มรอบ', 'cycle_end': 'สิ้นสุดรอบ', 'total_kwh': 'หน่วยไฟ (kWh)', 'kwh_peak': 'Peak (kWh)',
+                        'kwh_off_peak': 'Off-Peak (kWh)', 'demand_kw': 'Demand สูงสุด (kW)', 'base_energy_cost': 'ค่าพลังงาน', 'demand_charge': 'ค่าความต้องการพลังไฟฟ้า', 'service_charge': 'ค่าบริการ',
+                        'applicable_ft_rate': 'อัตรา Ft', 'ft_cost': 'ค่า Ft', 'vat_amount': 'VAT', 'final_bill': 'ค่าไฟสุทธิ (บาท)'
+                    }).dropna(axis=1, how='all'),
+                    hide_index=True, use_container_width=True
+                )
+
         # Detailed Results
         with st.expander("📄 รายละเอียดการคำนวณและดาวน์โหลด", expanded=False):
             display_customer_label = st.session_state.customer_type_label
-            if st.session_state.customer_type_label == "🏢 กิจการขนาดเล็ก":
+            if st.session_state.customer_type_label != "🏠 บ้านอยู่อาศัย":
                 display_customer_label += f" ({st.session_state.voltage_level})"
             
             output = [
@@ -1389,6 +1406,7 @@ if st.session_state.calculation_result:
             output.extend([
                 "-"*50,
                 f"{'ค่าพลังงานไฟฟ้า':<30}: {bill['base_energy_cost']:>15,.2f} บาท",
+                *([f"{f'ค่า Demand ({bill['demand_kw']:,.2f} kW)':<30}: {bill['demand_charge']:>15,.2f} บาท"] if bill.get('demand_kw') is not None else []),
                 f"{'ค่าบริการรายเดือน':<30}: {bill['service_charge']:>15,.2f} บาท",
                 f"{f'ค่า Ft (@{bill['applicable_ft_rate']:.4f})':<30}: {bill['ft_cost']:>15,.2f} บาท",
                 "-"*50,
@@ -1434,7 +1452,8 @@ if st.session_state.calculation_result:
                     bill_data=bill,
                     ev_data=ev_report_data,
                     df_plot=st.session_state.get('df_for_plotting'),
-                    settings=settings_data
+                    settings=settings_data,
+                    stats=st.session_state.get('plot_stats')
                 )
                 
                 # แสดงรายงานในหน้าต่างใหม่
@@ -1478,7 +1497,29 @@ if st.session_state.calculation_result:
         if df_plot is not None and not df_plot.empty:
             # Main load profile chart
             st.markdown("### 📊 Load Profile Analysis")
-            chart_data = create_enhanced_chart_data(df_plot)
+            plot_first_date, plot_last_date = df_plot['DateTime'].iloc[0].date(), df_plot['DateTime'].iloc[-1].date()
+            col_zoom, col_downsample = st.columns([3, 1])
+            with col_zoom:
+                zoom_range = st.slider(
+                    "🔍 ช่วงวันที่ที่แสดง:",
+                    min_value=plot_first_date,
+                    max_value=plot_last_date,
+                    value=(plot_first_date, plot_last_date),
+                    key="profile_zoom"
+                ) if plot_last_date > plot_first_date else (plot_first_date, plot_last_date)
+            with col_downsample:
+                downsample_method = st.selectbox(
+                    "📉 ลดจำนวนจุด:",
+                    [DOWNSAMPLE_MINMAX, DOWNSAMPLE_LTTB],
+                    format_func={DOWNSAMPLE_MINMAX: "Min/Max", DOWNSAMPLE_LTTB: "LTTB"}.get,
+                    key="profile_downsample",
+                    help=f"แสดงไม่เกิน {CHART_MAX_POINTS:,} จุด: Min/Max เก็บค่าสูงสุด/ต่ำสุดทุกช่วง, LTTB รักษารูปทรงของเส้น"
+                )
+            plot_pyramid = st.session_state.get('plot_pyramid')
+            if st.session_state.get('plot_key'):
+                chart_data = cached_chart_data(df_plot, st.session_state.plot_key, zoom_range, CHART_MAX_POINTS, downsample_method, plot_pyramid)
+            else:
+                chart_data = create_enhanced_chart_data(df_plot, zoom_range, CHART_MAX_POINTS, downsample_method, plot_pyramid)
             if chart_data is not None:
                 st.line_chart(chart_data, height=400)
             
@@ -1487,13 +1528,13 @@ if st.session_state.calculation_result:
             
             with col_chart1:
                 st.markdown("### 📊 การใช้ไฟเฉลี่ยรายวัน")
-                daily_data = create_daily_consumption_data(df_plot)
+                daily_data = create_daily_consumption_data(df_plot, plot_pyramid)
                 if daily_data is not None:
                     st.bar_chart(daily_data, height=300)
             
             with col_chart2:
                 st.markdown("### ⏰ รูปแบบการใช้ไฟตามชั่วโมง")
-                hourly_data = create_hourly_pattern_data(df_plot)
+                hourly_data = create_hourly_pattern_data(df_plot, plot_pyramid)
                 if hourly_data is not None:
                     st.line_chart(hourly_data, height=300)
             
@@ -1501,9 +1542,7 @@ if st.session_state.calculation_result:
             if st.session_state.tariff_type == '⏰ อัตรา TOU':
                 st.markdown("### ⏰ วิเคราะห์ Peak/Off-Peak")
                 
-                # Add TOU classification
-                df_plot['TOU_Period'] = df_plot['DateTime'].apply(classify_tou_period)
-                tou_summary = df_plot.groupby('TOU_Period')['Total import kW demand'].agg(['mean', 'sum', 'count'])
+                tou_summary = create_tou_summary_data(df_plot, plot_pyramid)
                 
                 col_tou1, col_tou2 = st.columns(2)
                 
@@ -1528,24 +1567,25 @@ if st.session_state.calculation_result:
             
             # Summary Statistics
             with st.expander("📊 สถิติการใช้ไฟ", expanded=False):
+                if st.session_state.get('plot_stats') is None: st.session_state.plot_stats = demand_stats(df_plot)
+                plot_stats = st.session_state.plot_stats
                 stats_col1, stats_col2, stats_col3, stats_col4 = st.columns(4)
                 
                 with stats_col1:
-                    st.metric("📈 ค่าสูงสุด", f"{df_plot['Total import kW demand'].max():.2f} kW")
-                    st.metric("📉 ค่าต่ำสุด", f"{df_plot['Total import kW demand'].min():.2f} kW")
+                    st.metric("📈 ค่าสูงสุด", f"{plot_stats['max_demand']:.2f} kW")
+                    st.metric("📉 ค่าต่ำสุด", f"{plot_stats['min_demand']:.2f} kW")
                 
                 with stats_col2:
-                    st.metric("📊 ค่าเฉลี่ย", f"{df_plot['Total import kW demand'].mean():.2f} kW")
-                    st.metric("📐 ค่ามัธยฐาน", f"{df_plot['Total import kW demand'].median():.2f} kW")
+                    st.metric("📊 ค่าเฉลี่ย", f"{plot_stats['avg_demand']:.2f} kW")
+                    st.metric("📐 ค่ามัธยฐาน", f"{plot_stats['median_demand']:.2f} kW")
                 
                 with stats_col3:
-                    st.metric("📏 ส่วนเบียงเบนมาตรฐาน", f"{df_plot['Total import kW demand'].std():.2f} kW")
-                    st.metric("🎯 Load Factor", f"{(df_plot['Total import kW demand'].mean() / df_plot['Total import kW demand'].max() * 100):.1f}%")
+                    st.metric("📏 ส่วนเบียงเบนมาตรฐาน", f"{plot_stats['std_demand']:.2f} kW")
+                    st.metric("🎯 Load Factor", f"{plot_stats['load_factor']:.1f}%")
                 
                 with stats_col4:
-                    peak_hours = len(df_plot[df_plot['Total import kW demand'] > df_plot['Total import kW demand'].quantile(0.9)])
-                    st.metric("⚡ จำนวนข้อมูล", f"{len(df_plot):,} รายการ")
-                    st.metric("🔥 ช่วง Peak (>90%)", f"{peak_hours:,} รายการ")
+                    st.metric("⚡ จำนวนข้อมูล", f"{plot_stats['total_records']:,} รายการ")
+                    st.metric("🔥 ช่วง Peak (>90%)", f"{plot_stats['records_above_p90']:,} รายการ")
         else:
             st.warning("⚠️ ไม่มีข้อมูลสำหรับสร้างกราฟ")
         
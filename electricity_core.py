@@ -0,0 +1,1366 @@
+# -*- coding: utf-8 -*-
+"""ส่วนคำนวณค่าไฟฟ้า: อัตราค่าไฟ, วันหยุด TOU, การอ่านไฟล์มิเตอร์ และการคำนวณบิล (ไม่ขึ้นกับ Streamlit)"""
+import pandas as pd
+import io
+import os
+import codecs
+import hashlib
+import json
+import re
+import bisect
+import functools
+import threading
+import weakref
+from collections import OrderedDict
+from datetime import datetime, time, date
+import calendar
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.feather as feather
+
+# ==============================================================================
+# --- ค่าคงที่และข้อมูลอัตรา (CONFIGURATIONS) ---
+# ==============================================================================
+
+# 1. อัตราค่าไฟฟ้า (Tariffs)
+TARIFFS = {
+    "residential": {
+        "normal": {
+            'service_charge_tiers': [
+                {'limit': 150, 'rate': 8.19},
+                {'limit': float('inf'), 'rate': 24.62}
+            ],
+            'type': 'tiered', 
+            'tiers': [
+                {'limit': 150, 'rate': 3.2484}, 
+                {'limit': 400, 'rate': 4.2218}, 
+                {'limit': float('inf'), 'rate': 4.4217}
+            ]
+        },
+        "tou": {'service_charge': 24.62, 'type': 'tou', 'peak_rate': 5.7982, 'off_peak_rate': 2.6369}
+    },
+    "smb_lv": { # กิจการขนาดเล็ก, แรงดันต่ำกว่า 22 kV
+        "normal": {'service_charge': 46.16, 'type': 'tiered', 'tiers': [{'limit': 150, 'rate': 3.2484}, {'limit': 400, 'rate': 4.2218}, {'limit': float('inf'), 'rate': 4.4217}]},
+        "tou": {'service_charge': 46.16, 'type': 'tou', 'peak_rate': 5.7982, 'off_peak_rate': 2.6369}
+    },
+    "smb_mv": { # กิจการขนาดเล็ก, แรงดัน 22-33 kV
+        "normal": {'service_charge': 312.24, 'type': 'flat', 'rate': 4.3168},
+        "tou": {'service_charge': 312.24, 'type': 'tou', 'peak_rate': 4.8773, 'off_peak_rate': 2.6549}
+    },
+    # กิจการขนาดกลาง: คิดค่าความต้องการพลังไฟฟ้า (demand_rate บาท/kW ต่อเดือน) เพิ่มจากค่าพลังงาน
+    # demand_period 'all' ใช้ Demand สูงสุดทั้งเดือน, 'peak' ใช้ Demand สูงสุดเฉพาะช่วง Peak (อัตรา TOU)
+    "mb_lv": { # กิจการขนาดกลาง, แรงดันต่ำกว่า 22 kV
+        "normal": {'service_charge': 312.24, 'type': 'flat', 'rate': 3.1751, 'demand_rate': 221.50, 'demand_period': 'all'},
+        "tou": {'service_charge': 312.24, 'type': 'tou', 'peak_rate': 4.3297, 'off_peak_rate': 2.6369, 'demand_rate': 210.00, 'demand_period': 'peak'}
+    },
+    "mb_mv": { # กิจการขนาดกลาง, แรงดัน 22-33 kV
+        "normal": {'service_charge': 312.24, 'type': 'flat', 'rate': 3.1471, 'demand_rate': 196.26, 'demand_period': 'all'},
+        "tou": {'service_charge': 312.24, 'type': 'tou', 'peak_rate': 4.1839, 'off_peak_rate': 2.6037, 'demand_rate': 132.93, 'demand_period': 'peak'}
+    }
+}
+
+@functools.lru_cache(maxsize=None)
+def get_compiled_tariff(customer_type_key, tariff_type_key):
+    """โครงสร้างอัตราจาก TARIFFS ในรูป NumPy array สำหรับคิดค่าไฟหลายบิลพร้อมกัน (สร้างครั้งเดียวต่ออัตรา)
+    tiered: ขอบบนของแต่ละขั้น, อัตรา, หน่วยเริ่มต้นของขั้น และค่าพลังงานสะสม ณ ต้นขั้น"""
+    rate_structure = TARIFFS[customer_type_key][tariff_type_key]
+    compiled = {'type': rate_structure['type']}
+    if rate_structure['type'] == 'flat': compiled['rate'] = rate_structure['rate']
+    elif rate_structure['type'] == 'tiered':
+        limits = np.array([tier['limit'] for tier in rate_structure['tiers']], dtype=float); rates = np.array([tier['rate'] for tier in rate_structure['tiers']], dtype=float)
+        tier_starts = np.r_[0.0, limits[:-1]]
+        compiled.update(limits=limits, rates=rates, tier_starts=tier_starts, cost_at_start=np.r_[0.0, np.cumsum((limits[:-1] - tier_starts[:-1]) * rates[:-1])])
+    elif rate_structure['type'] == 'tou': compiled.update(peak_rate=rate_structure['peak_rate'], off_peak_rate=rate_structure['off_peak_rate'])
+    if 'service_charge_tiers' in rate_structure:
+        compiled['service_limits'] = np.array([tier['limit'] for tier in rate_structure['service_charge_tiers']], dtype=float)
+        compiled['service_rates'] = np.array([tier['rate'] for tier in rate_structure['service_charge_tiers']], dtype=float)
+    else: compiled['service_charge'] = rate_structure['service_charge']
+    compiled['demand_rate'] = rate_structure.get('demand_rate', 0.0)
+    return compiled
+
+# 2. อัตราค่า Ft (Fuel Adjustment Charge)
+FT_RATES = {
+    (2023, 1): 0.9343, (2023, 5): 0.9119, (2023, 9): 0.2048,
+    (2024, 1): 0.3972, (2024, 5): 0.3972, (2024, 9): 0.3972,
+    (2025, 1): 0.3972, (2025, 5): 0.1972, (2025, 9): 0.1972,
+}
+
+FT_MODE_PERIOD_END = 'period_end'  # ใช้อัตรา Ft ของวันสุดท้ายในช่วงข้อมูลกับหน่วยทั้งหมด
+FT_MODE_PRORATED = 'prorated'      # คิดแต่ละช่วงเวลาตามอัตรา Ft ที่มีผล ณ เวลานั้น
+FT_MODES = (FT_MODE_PERIOD_END, FT_MODE_PRORATED)
+
+@functools.lru_cache(maxsize=None)
+def get_ft_rate_index():
+    """วันเริ่มงวด Ft เรียงจากน้อยไปมาก (tuple ของ date และ datetime64[D]) กับอัตราที่คู่กัน สร้างครั้งเดียวจาก FT_RATES"""
+    periods = sorted(FT_RATES)
+    period_start_dates = tuple(date(year, month, 1) for year, month in periods)
+    return period_start_dates, np.array(period_start_dates, dtype='datetime64[D]'), np.array([FT_RATES[p] for p in periods], dtype=float)
+
+# 3. วันหยุดสำหรับอัตรา TOU (ไฟล์ปฏิทินรายปี โหลดเมื่อใช้ครั้งแรก ไม่มีการคำนวณตอน import)
+# ไฟล์ชื่อ <ปี>_v<รุ่น>.json ({"year": ..., "version": ..., "holidays": ["YYYY-MM-DD", ...]}) หรือ <ปี>_v<รุ่น>.csv (คอลัมน์ date)
+# ปีเดียวกันมีหลายรุ่นได้ ใช้รุ่นสูงสุด ถ้ารุ่นเท่ากันไฟล์ในโฟลเดอร์ที่ระบุด้วย ELECTRICITY_HOLIDAY_DIR มาก่อนไฟล์ที่มากับโปรแกรม
+HOLIDAY_CALENDAR_DIRS = [
+    *[path for path in os.environ.get('ELECTRICITY_HOLIDAY_DIR', '').split(os.pathsep) if path],
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'holidays'),
+]
+HOLIDAY_CALENDAR_FILE_PATTERN = re.compile(r'^(\d{4})_v(\d+)\.(json|csv)$')
+
+@functools.lru_cache(maxsize=None)
+def get_holiday_calendar_files():
+    """ไฟล์ปฏิทินวันหยุดที่ใช้ของแต่ละปี dict ปี -> (รุ่น, path) สแกนโฟลเดอร์ครั้งแรกที่ถูกเรียก"""
+    calendar_files = {}
+    for directory in reversed(HOLIDAY_CALENDAR_DIRS):
+        if not os.path.isdir(directory): continue
+        for entry in os.scandir(directory):
+            match = HOLIDAY_CALENDAR_FILE_PATTERN.match(entry.name)
+            if not match or not entry.is_file(): continue
+            year, version = int(match.group(1)), int(match.group(2))
+            if year not in calendar_files or version >= calendar_files[year][0]: calendar_files[year] = (version, entry.path)
+    return calendar_files
+
+def read_holiday_calendar(path):
+    """รายการวันหยุด (สตริง YYYY-MM-DD) จากไฟล์ปฏิทิน JSON หรือ CSV"""
+    if path.lower().endswith('.csv'): return pd.read_csv(path, dtype=str, encoding='utf-8-sig')['date'].str.strip().tolist()
+    with open(path, encoding='utf-8-sig') as f:
+        return [str(d_str) for d_str in json.load(f)['holidays']]
+
+@functools.lru_cache(maxsize=None)
+def get_tou_holidays(year):
+    """วัน Off-Peak ทั้งวันของปี (เสาร์-อาทิตย์และวันหยุดจากไฟล์ปฏิทิน) สร้างเมื่อถูกเรียกครั้งแรก
+    คืนค่า (bitmap bool หนึ่งช่องต่อวัน เริ่มที่ 1 ม.ค., รายการวันที่ที่รูปแบบผิดหรือไม่อยู่ในปีนั้น) หรือ None หากไม่มีไฟล์ของปีนั้น"""
+    calendar_file = get_holiday_calendar_files().get(year)
+    if calendar_file is None: return None
+    holiday_strs = read_holiday_calendar(calendar_file[1])
+    year_start = np.datetime64(f'{year:04d}-01-01', 'D'); days_in_year = 366 if calendar.isleap(year) else 365
+    bitmap = (np.arange(days_in_year) + year_start.astype('int64') + 3) % 7 >= 5  # วันเสาร์-อาทิตย์ (1970-01-01 เป็นวันพฤหัสบดี)
+    day_offsets = (pd.to_datetime(pd.Series(holiday_strs, dtype=object), format='%Y-%m-%d', errors='coerce').to_numpy(dtype='datetime64[D]') - year_start).astype('int64')
+    in_year = (day_offsets >= 0) & (day_offsets < days_in_year)
+    bitmap[day_offsets[in_year]] = True
+    return bitmap, tuple(d_str for d_str, ok in zip(holiday_strs, in_year) if not ok)
+
+@functools.lru_cache(maxsize=32)
+def get_offpeak_day_table(first_year, last_year):
+    """bitmap วัน Off-Peak ต่อเนื่องตั้งแต่ 1 ม.ค. first_year ถึง 31 ธ.ค. last_year (ปีที่ไม่มีไฟล์ปฏิทินเป็น False ทั้งปี)"""
+    return np.concatenate([
+        year_holidays[0] if (year_holidays := get_tou_holidays(year)) is not None else np.zeros(366 if calendar.isleap(year) else 365, dtype=bool)
+        for year in range(first_year, last_year + 1)
+    ])
+
+def is_offpeak_day(days):
+    """วันใดเป็นวัน Off-Peak ทั้งวัน สำหรับ array ของ datetime64[D] (NaT ได้ False) เปิดตาราง bitmap ครั้งเดียวต่อแถว O(1)"""
+    days = np.asarray(days, dtype='datetime64[D]')
+    valid = ~np.isnat(days)
+    if not valid.any(): return np.zeros(days.shape, dtype=bool)
+    first_day, last_day = (days.min(), days.max()) if valid.all() else (days[valid].min(), days[valid].max())
+    first_year = first_day.astype('datetime64[Y]').astype('int64') + 1970
+    table = get_offpeak_day_table(int(first_year), int(last_day.astype('datetime64[Y]').astype('int64') + 1970))
+    offsets = (days - np.datetime64(f'{first_year:04d}-01-01', 'D')).astype('int64')
+    return table[np.where(valid, offsets, 0)] & valid
+
+# 4. ค่าคงที่อื่นๆ
+VAT_RATE = 0.07; PEAK_START = time(9, 0, 0); PEAK_END = time(21, 59, 59)
+
+# 5. การอ่านไฟล์แบบ stream
+TEXT_ENCODINGS = ['utf-8', 'cp874', 'tis-620']
+SNIFF_BLOCK_BYTES = 64 * 1024  # อ่านต้นไฟล์และท้ายไฟล์ไม่เกินขนาดนี้เพื่อเดา encoding/ประเภทไฟล์
+SNIFF_DELIMITERS = ('\t', ',', ';')
+PARSE_CHUNK_ROWS = 200_000
+FILE_TYPE_AUTO = 'auto'  # ให้ parse_data_file ตรวจประเภทไฟล์เองด้วย sniff_meter_file
+METER_COLUMNS = ('DateTime', 'Total import kW demand')
+CSV_ENGINE_PANDAS = 'pandas'  # pd.read_csv ทีละ chunk (parse_text_file_streaming)
+CSV_ENGINE_ARROW = 'arrow'    # pyarrow.csv อ่านหลายบล็อกพร้อมกันเฉพาะคอลัมน์ที่ใช้ (parse_text_file_arrow)
+CSV_ENGINES = (CSV_ENGINE_PANDAS, CSV_ENGINE_ARROW)
+ARROW_CSV_MIN_BYTES = 64 * 1024  # ไฟล์ที่เล็กกว่านี้ใช้ pandas (เร็วพอกันและไม่ต้องเริ่ม thread ของ Arrow)
+ARROW_CSV_BLOCK_BYTES = 1024 * 1024  # ขนาดบล็อกที่แต่ละ thread แปลง
+
+# 6. หน่วย Demand ของไฟล์แต่ละประเภท
+DEMAND_UNIT_NOTES = {
+    'BLE-iMeter': "✅ หน่วย Demand ในไฟล์ BLE-iMeter เป็น Watt (W), แปลงเป็น kW โดยการหาร 1000",
+    'IPG': "✅ หน่วย Demand ในไฟล์ IPG เป็น Kilowatt (kW)",
+    'มิเตอร์ PEA (CSV)': "✅ สันนิษฐานว่าหน่วย Demand ในไฟล์ CSV เป็น Kilowatt (kW)",
+}
+
+# 7. แคชข้อมูลที่ประมวลผลแล้วบนดิสก์ (Feather)
+PARSED_CACHE_DIR = os.environ.get('ELECTRICITY_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'electricity-calculator'))
+PARSED_CACHE_MAX_BYTES = int(os.environ.get('ELECTRICITY_CACHE_MAX_MB', '2048')) * 1024 * 1024
+PARSED_CACHE_VERSION = 3
+DATASET_REGISTRY_MAX_BYTES = int(os.environ.get('ELECTRICITY_REGISTRY_MAX_MB', '1024')) * 1024 * 1024  # ข้อมูลที่ใช้ร่วมกันทุก session ในหน่วยความจำ
+
+# 8. วิธีแปลงกำลังไฟ (kW) เป็นหน่วยไฟ (kWh)
+ENERGY_METHOD_FIXED = 'fixed'          # ช่วงเวลาคงที่จากสองแถวแรก (วิธีเดิม)
+ENERGY_METHOD_LEFT = 'left'            # Left Riemann ตามช่วงเวลาจริงของแต่ละแถว
+ENERGY_METHOD_TRAPEZOID = 'trapezoid'  # Trapezoidal ระหว่างแถวที่ติดกัน
+ENERGY_METHODS = (ENERGY_METHOD_FIXED, ENERGY_METHOD_LEFT, ENERGY_METHOD_TRAPEZOID)
+MAX_GAP_HOURS = 1.0  # ช่วงห่างที่ยาวกว่านี้ (และยาวกว่าช่วงปกติ) ถือเป็นข้อมูลขาดหาย
+
+# 9. การลดจำนวนจุดของกราฟ
+CHART_MAX_POINTS = 2000  # จำนวนจุดสูงสุดที่ส่งไปยังเบราว์เซอร์ต่อหนึ่งเส้น (ประมาณความกว้างกราฟเป็นพิกเซล)
+DOWNSAMPLE_MINMAX = 'minmax'  # เก็บจุดต่ำสุดและสูงสุดของแต่ละช่วง (ไม่พลาด Peak)
+DOWNSAMPLE_LTTB = 'lttb'      # Largest-Triangle-Three-Buckets (รูปทรงเส้นใกล้ของจริง)
+DOWNSAMPLE_METHODS = (DOWNSAMPLE_MINMAX, DOWNSAMPLE_LTTB)
+PYRAMID_LEVELS = ('15min', '1h', '1D', '1W')  # ระดับข้อมูลสรุปสำหรับกราฟ จากละเอียดไปหยาบ (สัปดาห์เริ่มวันจันทร์)
+PYRAMID_STEPS_NS = {'15min': 15 * 60 * 10**9, '1h': 3600 * 10**9, '1D': 86400 * 10**9}
+
+# 10. สถิติการใช้ไฟ
+STATS_SKETCH_ACCURACY = 0.001  # ค่าคลาดเคลื่อนสัมพัทธ์สูงสุดของมัธยฐาน/percentile จาก quantile sketch
+
+# 11. ชนิดข้อมูลของ DataFrame ที่เก็บไว้ใน session (ประหยัดหน่วยความจำ)
+DEMAND_DTYPE = np.float32  # Demand (kW) ที่อ่านจากไฟล์ ความละเอียดเกินกว่าที่มิเตอร์บันทึก
+HOUR_DTYPE = np.uint8      # ชั่วโมงของวัน (0-23) สำหรับจัดกลุ่ม
+
+# 12. รูปแบบวันเวลาของแต่ละประเภทไฟล์ (ตรวจจากตัวอย่างของ chunk แรกครั้งเดียว แล้วใช้รูปแบบแรกที่แปลงตัวอย่างได้ทุกแถวกับทั้งไฟล์)
+DATETIME_SAMPLE_ROWS = 256  # จำนวนแถวตัวอย่าง เลือกกระจายทั้ง chunk เพื่อแยก วัน/เดือน ที่สลับกันได้
+DATETIME_FORMATS = {
+    'BLE-iMeter': {'formats': ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y/%m/%d %H:%M:%S', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M', '%m/%d/%Y %H:%M:%S', '%m/%d/%Y %H:%M'), 'dayfirst': False, 'buddhist_year': False},
+    'IPG': {'formats': ('%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M'), 'dayfirst': True, 'buddhist_year': True},
+    'มิเตอร์ PEA (CSV)': {'formats': ('%d/%m/%Y %H:%M', '%d/%m/%Y %H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%d-%m-%Y %H:%M', '%d-%m-%Y %H:%M:%S'), 'dayfirst': True, 'buddhist_year': False},
+}
+DATETIME_FIELDS = {'%Y': 'yyyy', '%m': 'mm', '%d': 'dd', '%H': 'HH', '%M': 'MM', '%S': 'SS'}
+
+# 13. ค่าความต้องการพลังไฟฟ้า (Demand Charge) ของอัตราที่มี 'demand_rate'
+DEMAND_WINDOW_MINUTES = 15  # Demand ที่คิดเงินคือค่าเฉลี่ยในช่วง 15 นาทีที่สูงที่สุดของรอบบิล
+DEMAND_PERIOD_PEAK = 'peak'  # นับเฉพาะช่วงเวลา Peak
+DEMAND_PERIOD_ALL = 'all'    # นับทุกช่วงเวลา
+DEMAND_PERIODS = (DEMAND_PERIOD_PEAK, DEMAND_PERIOD_ALL)
+
+# 14. คอลัมน์ของตารางเปรียบเทียบค่าไฟทุกอัตรา (tariff_cost_matrix)
+TARIFF_MATRIX_COLUMNS = ('total_kwh', 'base_energy_cost', 'demand_kw', 'demand_charge', 'service_charge', 'ft_cost', 'total_before_vat', 'vat_amount', 'final_bill')
+
+# ==============================================================================
+# --- ฟังก์ชัน Helper ---
+# ==============================================================================
+def sniff_text_encoding(uploaded_file, encodings=TEXT_ENCODINGS):
+    """เดา encoding จากบล็อกแรกและบล็อกสุดท้ายของไฟล์ (อ่านไม่เกิน 2 x SNIFF_BLOCK_BYTES) คืนค่า (encoding, ข้อความในบล็อกแรก)
+    ไฟล์ที่ขึ้นต้นด้วย BOM ใช้ utf-8-sig encoding ที่ถอดรหัสได้ทั้งสองบล็อกมักถอดรหัสได้ทั้งไฟล์ จึงไม่ต้องอ่านทั้งไฟล์ซ้ำด้วย encoding อื่น"""
+    uploaded_file.seek(0); head_bytes = uploaded_file.read(SNIFF_BLOCK_BYTES)
+    uploaded_file.seek(0, os.SEEK_END); file_size = uploaded_file.tell(); tail_bytes = b''
+    if file_size > len(head_bytes):
+        uploaded_file.seek(max(len(head_bytes), file_size - SNIFF_BLOCK_BYTES))
+        tail_bytes = uploaded_file.read().lstrip(bytes(range(0x80, 0xC0)))  # ตัดไบต์ต่อท้ายของอักขระ UTF-8 ที่ขาดครึ่ง
+    uploaded_file.seek(0)
+    if not head_bytes: raise ValueError("ไม่สามารถอ่านไฟล์ได้ หรือไฟล์ว่างเปล่า")
+    if head_bytes.startswith(codecs.BOM_UTF8): encodings = ['utf-8-sig']
+    for enc in encodings:
+        try:
+            head_text = codecs.getincrementaldecoder(enc)().decode(head_bytes, final=False)
+            codecs.getincrementaldecoder(enc)().decode(tail_bytes, final=True)
+            return enc, head_text
+        except UnicodeDecodeError: continue
+    raise ValueError("ไม่สามารถอ่านไฟล์ได้ หรือไฟล์ว่างเปล่า")
+
+def sniff_meter_file(uploaded_file):
+    """ตรวจประเภทไฟล์มิเตอร์, encoding และตัวคั่นจากต้นไฟล์ (ไม่อ่านทั้งไฟล์)
+    IPG: หัวตารางคั่นด้วย tab, มิเตอร์ PEA (CSV): หัวตารางคั่นด้วย , หรือ ;, BLE-iMeter: ไม่มีหัวตาราง คั่นด้วย , อย่างน้อย 4 คอลัมน์
+    คืน dict: file_type (None หากระบุไม่ได้), encoding, delimiter, first_line, file_size (ไบต์)"""
+    encoding, head_text = sniff_text_encoding(uploaded_file)
+    lines = [line for line in head_text.splitlines()[:20] if line.strip()]
+    if len(head_text) >= SNIFF_BLOCK_BYTES // 4 and len(lines) > 1: lines = lines[:-1]  # บรรทัดสุดท้ายของบล็อกอาจขาดครึ่ง
+    if not lines: raise ValueError("ไม่สามารถอ่านไฟล์ได้ หรือไฟล์ว่างเปล่า")
+    # ตัวคั่นคือตัวที่ปรากฏจำนวนเท่ากันทุกบรรทัดมากที่สุด
+    delimiter = max(SNIFF_DELIMITERS, key=lambda sep: (min(line.count(sep) for line in lines), -len({line.count(sep) for line in lines})))
+    header_cols = [col.strip().strip('"') for col in lines[0].split(delimiter)]
+    file_type = None
+    if all(col in header_cols for col in METER_COLUMNS): file_type = 'IPG' if delimiter == '\t' else 'มิเตอร์ PEA (CSV)'
+    elif delimiter == ',' and lines[0].count(',') >= 3: file_type = 'BLE-iMeter'
+    uploaded_file.seek(0, os.SEEK_END); file_size = uploaded_file.tell(); uploaded_file.seek(0)
+    return {'file_type': file_type, 'encoding': encoding, 'delimiter': delimiter, 'first_line': lines[0], 'file_size': file_size}
+
+def iter_csv_chunks(uploaded_file, encoding, chunksize=PARSE_CHUNK_ROWS, **read_csv_kwargs):
+    """อ่าน CSV ทีละ chunk โดยถอดรหัสข้อความระหว่างอ่าน ไม่ต้องเก็บข้อความทั้งไฟล์ไว้ในหน่วยความจำ"""
+    uploaded_file.seek(0)
+    text_stream = io.TextIOWrapper(uploaded_file, encoding=encoding)
+    try:
+        with pd.read_csv(text_stream, chunksize=chunksize, **read_csv_kwargs) as reader:
+            yield from reader
+    finally:
+        text_stream.detach()
+
+def _ble_chunk_to_frame(chunk, parse_datetimes):
+    return pd.DataFrame({
+        'DateTime': parse_datetimes(chunk[1]),
+        'Total import kW demand': pd.to_numeric(chunk[3], errors='coerce') / 1000.0
+    })
+
+def correct_buddhist_year(dt_str):
+    try:
+        parts = dt_str.split(' '); date_part = parts[0]; date_components = date_part.split('/')
+        if len(date_components) == 3:
+            day, month, year_be = map(int, date_components)
+            year_ce = datetime.now().year if year_be < 1000 else year_be - 543
+            return datetime(year_ce, month, day).strftime('%Y-%m-%d') + ' ' + parts[1]
+    except Exception: return None
+    return dt_str
+
+def _fixed_layout(datetime_format):
+    """layout ความยาวคงที่ของ format เช่น '%d/%m/%Y %H:%M' -> 'dd/mm/yyyy HH:MM' (None หากมี directive อื่น)"""
+    layout = datetime_format
+    for directive, field in DATETIME_FIELDS.items(): layout = layout.replace(directive, field)
+    return None if '%' in layout else layout
+
+def _assemble_datetimes(year, month, day, hour, minute, second):
+    """ประกอบ datetime64[us] จากตัวเลขแต่ละส่วนทั้งคอลัมน์ด้วย numpy (วันที่หรือเวลาที่ไม่มีจริงเป็น NaT)"""
+    months = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+    dates = months.astype('datetime64[D]') + (day - 1).astype('timedelta64[D]')
+    valid = (month >= 1) & (month <= 12) & (day >= 1) & (dates < (months + 1).astype('datetime64[D]')) & (hour < 24) & (minute < 60) & (second < 60)
+    values = dates.astype('datetime64[us]') + (hour * 3600 + minute * 60 + second).astype('timedelta64[s]')
+    values[~valid] = np.datetime64('NaT')
+    return values
+
+def _fixed_width_chars(dt_series, width):
+    """ไบต์ของสตริงทุกแถวเป็น array (แถว, width) อ่านจาก buffer ของ Arrow โดยไม่สร้างสตริง Python ทีละแถว
+    คืน None หากมีค่าว่างหรือแถวที่ยาวไม่เท่า width ไบต์"""
+    try: arrow = pa.array(dt_series, type=pa.large_string())
+    except (pa.ArrowInvalid, pa.ArrowTypeError): return None
+    if isinstance(arrow, pa.ChunkedArray): arrow = arrow.combine_chunks()  # คอลัมน์ที่อ่านด้วย Arrow มีหลาย chunk
+    if len(arrow) == 0 or arrow.null_count: return None
+    offsets = np.frombuffer(arrow.buffers()[1], dtype=np.int64)[arrow.offset:arrow.offset + len(arrow) + 1]
+    if not (np.diff(offsets) == width).all(): return None
+    return np.frombuffer(arrow.buffers()[2], dtype=np.uint8)[offsets[0]:offsets[-1]].reshape(len(arrow), width)
+
+def _parse_fixed_layout_datetimes(dt_series, layout, buddhist_year=False):
+    """แยกตัวเลขจากไบต์ของสตริงความยาวคงที่ตาม layout (เช่น dd/mm/yyyy HH:MM:SS) โดยตรง แถวที่ไม่ตรงรูปแบบเป็น NaT
+    คืน None หากมีแถวที่ยาวไม่เท่า layout"""
+    chars = _fixed_width_chars(dt_series, len(layout))
+    if chars is None: return None
+    digit_cols = [i for i, c in enumerate(layout) if c in 'ymdHMS']
+    sep_cols = [i for i, c in enumerate(layout) if c not in 'ymdHMS']
+    digits = chars[:, digit_cols].astype(np.int32) - ord('0')
+    layout_ok = ((digits >= 0) & (digits <= 9)).all(axis=1) & (chars[:, sep_cols] == np.frombuffer(''.join(layout[i] for i in sep_cols).encode(), dtype=np.uint8)).all(axis=1)
+    fields = {}
+    for letter in 'ymdHMS':
+        cols = [k for k, i in enumerate(digit_cols) if layout[i] == letter]
+        fields[letter] = digits[:, cols] @ 10 ** np.arange(len(cols) - 1, -1, -1, dtype=np.int32) if cols else np.zeros(len(chars), dtype=np.int32)
+    year = np.where(fields['y'] < 1000, datetime.now().year, fields['y'] - 543) if buddhist_year else fields['y']
+    values = _assemble_datetimes(year, fields['m'], fields['d'], fields['H'], fields['M'], fields['S'])
+    values[~layout_ok] = np.datetime64('NaT')
+    return values
+
+def _parse_datetimes_without_format(dt_series, spec):
+    """วิธีเดิมเมื่อไม่ทราบรูปแบบ: ให้ pandas เดารูปแบบ หรือแก้ปี พ.ศ. ด้วย correct_buddhist_year ทีละแถว"""
+    if spec['buddhist_year']: return pd.to_datetime(dt_series.apply(correct_buddhist_year), errors='coerce')
+    return pd.to_datetime(dt_series, dayfirst=spec['dayfirst'], errors='coerce')
+
+def parse_meter_datetimes(dt_series, file_type, datetime_format=None, fallback=True):
+    """แปลงคอลัมน์วันเวลาของไฟล์ประเภท file_type ด้วยรูปแบบที่ระบุ
+    แถวที่ยาวเท่า layout ของรูปแบบแยกตัวเลขจากไบต์โดยตรง แถวอื่นใช้ pd.to_datetime(format=...) (ปี พ.ศ. ใช้วิธีเดิม เว้นแต่ fallback=False)
+    datetime_format=None ใช้วิธีเดิมทั้งคอลัมน์"""
+    spec = DATETIME_FORMATS[file_type]
+    if datetime_format is None: return _parse_datetimes_without_format(dt_series, spec)
+    notna = dt_series.notna().to_numpy(); positions = np.flatnonzero(notna)
+    present = dt_series[notna].astype(str); layout = _fixed_layout(datetime_format)
+    fits = (present.str.len() == len(layout)).to_numpy() if layout else np.zeros(len(present), dtype=bool)
+    fixed_values = _parse_fixed_layout_datetimes(present[fits], layout, spec['buddhist_year']) if fits.any() else None
+    if fixed_values is None: fits = np.zeros(len(present), dtype=bool)
+    values = np.full(len(dt_series), np.datetime64('NaT'), dtype='datetime64[us]')
+    if fits.any(): values[positions[fits]] = fixed_values
+    rest = present[~fits]
+    if len(rest) and not spec['buddhist_year']: values[positions[~fits]] = pd.to_datetime(rest, format=datetime_format, errors='coerce').to_numpy(dtype='datetime64[us]')
+    elif len(rest) and fallback: values[positions[~fits]] = _parse_datetimes_without_format(rest, spec).to_numpy(dtype='datetime64[us]')
+    return pd.Series(values, index=dt_series.index)
+
+def detect_datetime_format(dt_series, file_type):
+    """รูปแบบใน DATETIME_FORMATS[file_type] ที่แปลงแถวตัวอย่าง (กระจายทั้งคอลัมน์) ได้มากที่สุด (เท่ากันเลือกรูปแบบที่อยู่ก่อน)
+    คืน None หากไม่มีรูปแบบใดแปลงได้เกินครึ่งของตัวอย่าง"""
+    present = dt_series.dropna()
+    if len(present) == 0: return None
+    sample = present.iloc[np.unique(np.linspace(0, len(present) - 1, DATETIME_SAMPLE_ROWS).astype(np.int64))].astype(str)
+    best_format, best_failures = None, len(sample) // 2 + 1
+    for datetime_format in DATETIME_FORMATS[file_type]['formats']:
+        failures = int(parse_meter_datetimes(sample, file_type, datetime_format, fallback=False).isna().sum())
+        if failures < best_failures: best_format, best_failures = datetime_format, failures
+        if failures == 0: break
+    return best_format
+
+class MeterDatetimeParser:
+    """แปลงคอลัมน์วันเวลาของไฟล์หนึ่งไฟล์ทีละ chunk: ตรวจรูปแบบจาก chunk แรกครั้งเดียว แล้วใช้รูปแบบเดียวกันทุก chunk"""
+    def __init__(self, file_type):
+        self.file_type = file_type; self.datetime_format = None; self.detected = False
+
+    def __call__(self, dt_series):
+        if not self.detected:
+            self.datetime_format = detect_datetime_format(dt_series, self.file_type); self.detected = True
+        return parse_meter_datetimes(dt_series, self.file_type, self.datetime_format)
+
+def detected_file_type(sniffed):
+    """ประเภทไฟล์จากผลของ sniff_meter_file (ValueError หากระบุไม่ได้)"""
+    if sniffed['file_type'] is None:
+        raise ValueError(f"ไม่สามารถระบุประเภทไฟล์ได้: ต้องเป็นไฟล์ BLE-iMeter (ไม่มีหัวตาราง คั่นด้วย ,) หรือไฟล์ที่มีคอลัมน์ '{METER_COLUMNS[0]}' และ '{METER_COLUMNS[1]}'")
+    return sniffed['file_type']
+
+def _header_chunk_to_frame(chunk, parse_datetimes):
+    chunk.columns = chunk.columns.str.strip().str.strip('"')
+    return pd.DataFrame({
+        'DateTime': parse_datetimes(chunk['DateTime']),
+        'Total import kW demand': pd.to_numeric(chunk['Total import kW demand'], errors='coerce')
+    })
+
+def parse_text_file_streaming(uploaded_file, file_type, chunksize=PARSE_CHUNK_ROWS, sniffed=None):
+    """แปลงไฟล์ BLE-iMeter / IPG / มิเตอร์ PEA (CSV) ทีละ chunk แล้วต่อเฉพาะคอลัมน์ DateTime / Total import kW demand
+    ถอดรหัสทั้งไฟล์ครั้งเดียวด้วย encoding จาก sniff_meter_file (ลอง encoding ถัดไปเฉพาะเมื่อถอดรหัสกลางไฟล์ไม่ได้)"""
+    sniffed = sniffed or sniff_meter_file(uploaded_file)
+    first_line = sniffed['first_line']
+    if file_type == 'BLE-iMeter':
+        n_cols = first_line.count(',') + 1
+        if n_cols < 4: raise ValueError(f"ไฟล์ BLE-iMeter CSV มี {n_cols} คอลัมน์ ไม่เพียงพอ")
+        read_kwargs = dict(sep=',', header=None, usecols=[1, 3])
+        chunk_to_frame = _ble_chunk_to_frame
+    else:
+        delimiter = '\t' if file_type == 'IPG' else sniffed['delimiter']
+        header_cols = [col.strip().strip('"') for col in first_line.split(delimiter)]
+        if not all(col in header_cols for col in METER_COLUMNS):
+            raise ValueError(f"ไฟล์ {file_type} ต้องมีคอลัมน์: '{METER_COLUMNS[0]}' และ '{METER_COLUMNS[1]}'")
+        read_kwargs = dict(sep=delimiter, header=0, skipinitialspace=True, usecols=lambda col: col.strip().strip('"') in METER_COLUMNS)
+        chunk_to_frame = _header_chunk_to_frame
+
+    sniffed_enc = sniffed['encoding']
+    encodings = [sniffed_enc] + [enc for enc in TEXT_ENCODINGS[TEXT_ENCODINGS.index(sniffed_enc) + 1 if sniffed_enc in TEXT_ENCODINGS else 1:]]
+    for enc in encodings:
+        try:
+            parse_datetimes = MeterDatetimeParser(file_type)
+            frames = [chunk_to_frame(chunk, parse_datetimes).dropna() for chunk in iter_csv_chunks(uploaded_file, enc, chunksize, **read_kwargs)]
+            break
+        except UnicodeDecodeError:
+            if enc == encodings[-1]: raise ValueError("ไม่สามารถอ่านไฟล์ได้ หรือไฟล์ว่างเปล่า")
+    if not frames: raise ValueError("ไม่สามารถอ่านไฟล์ได้ หรือไฟล์ว่างเปล่า")
+    return pd.concat(frames, ignore_index=True)
+
+def parse_text_file_arrow(uploaded_file, file_type, sniffed):
+    """อ่านเฉพาะคอลัมน์ DateTime / Demand ด้วย pyarrow.csv.open_csv ทีละบล็อก ARROW_CSV_BLOCK_BYTES (แปลงด้วยหลาย thread)
+    รวม record batch ครั้งละประมาณ PARSE_CHUNK_ROWS แถวแล้วแปลงเป็น DataFrame ทันที หน่วยความจำสูงสุดจึงขึ้นกับคอลัมน์ผลลัพธ์เหมือน parse_text_file_streaming
+    Demand ที่เป็นตัวเลขทั้ง chunk แปลงใน Arrow แล้วรวมเป็น chunk เดียวให้ pandas ใช้ buffer เดิมได้ (ไม่มีค่าว่าง) นอกนั้นใช้ pd.to_numeric(errors='coerce') เหมือนเดิม
+    คืน None หาก Arrow อ่านไฟล์นี้ไม่ได้ (เช่น จำนวนคอลัมน์ไม่เท่ากันทุกแถว หรือถอดรหัสไม่ได้) ให้ใช้ parse_text_file_streaming แทน"""
+    first_line = sniffed['first_line']
+    if file_type == 'BLE-iMeter':
+        if first_line.count(',') < 3: return None
+        read_options = pa_csv.ReadOptions(autogenerate_column_names=True)
+        delimiter = ','; dt_col, kw_col = 'f1', 'f3'
+    else:
+        delimiter = '\t' if file_type == 'IPG' else sniffed['delimiter']
+        header_cols = [col.strip().strip('"') for col in first_line.split(delimiter)]
+        if any(header_cols.count(col) != 1 for col in METER_COLUMNS): return None
+        read_options = pa_csv.ReadOptions(column_names=header_cols, skip_rows=1)  # ใช้ชื่อคอลัมน์ที่ตัดช่องว่าง/เครื่องหมายคำพูดแล้ว
+        dt_col, kw_col = METER_COLUMNS
+    read_options.use_threads = True; read_options.block_size = ARROW_CSV_BLOCK_BYTES
+    read_options.encoding = 'utf8' if sniffed['encoding'] in ('utf-8', 'utf-8-sig') else sniffed['encoding']
+    convert_options = pa_csv.ConvertOptions(include_columns=[dt_col, kw_col], column_types={dt_col: pa.string(), kw_col: pa.string()}, strings_can_be_null=True)
+    parse_datetimes = MeterDatetimeParser(file_type); frames = []; pending = []; pending_rows = 0
+    uploaded_file.seek(0)
+    try:
+        for batch in pa_csv.open_csv(uploaded_file, read_options, pa_csv.ParseOptions(delimiter=delimiter), convert_options):
+            pending.append(batch); pending_rows += batch.num_rows
+            if pending_rows >= PARSE_CHUNK_ROWS:
+                frames.append(_arrow_batches_to_frame(pending, dt_col, kw_col, file_type, parse_datetimes)); pending = []; pending_rows = 0
+    except (pa.ArrowInvalid, UnicodeDecodeError): return None
+    finally: uploaded_file.seek(0)
+    if pending_rows: frames.append(_arrow_batches_to_frame(pending, dt_col, kw_col, file_type, parse_datetimes))
+    if not frames: return None
+    return pd.concat(frames, ignore_index=True)
+
+def _arrow_batches_to_frame(batches, dt_col, kw_col, file_type, parse_datetimes):
+    table = pa.Table.from_batches(batches)
+    dt_values = pc.utf8_ltrim_whitespace(table.column(dt_col)).combine_chunks()
+    kw_strings = pc.utf8_ltrim_whitespace(table.column(kw_col))
+    try: kw_values = pc.cast(kw_strings, pa.float64()).combine_chunks().to_pandas()
+    except pa.ArrowInvalid: kw_values = pd.to_numeric(kw_strings.to_pandas(), errors='coerce')
+    if file_type == 'BLE-iMeter': kw_values = kw_values / 1000.0
+    return pd.DataFrame({'DateTime': parse_datetimes(dt_values.to_pandas()), 'Total import kW demand': kw_values}).dropna()
+
+def choose_csv_engine(file_size):
+    """เลือกวิธีอ่านไฟล์ตามขนาด: ไฟล์ใหญ่ใช้ Arrow ไฟล์เล็กใช้ pandas"""
+    return CSV_ENGINE_ARROW if file_size >= ARROW_CSV_MIN_BYTES else CSV_ENGINE_PANDAS
+
+def parse_data_file(uploaded_file, file_type, engine=None):
+    """engine: CSV_ENGINE_PANDAS / CSV_ENGINE_ARROW (None เลือกตามขนาดไฟล์ด้วย choose_csv_engine)
+    ไฟล์ที่ Arrow อ่านไม่ได้จะอ่านด้วย pandas แทนเสมอ ผลลัพธ์ของทั้งสองวิธีเหมือนกัน"""
+    if uploaded_file is None: return None
+    
+    df = None
+
+    try:
+        if file_type == FILE_TYPE_AUTO or file_type in DEMAND_UNIT_NOTES:
+            sniffed = sniff_meter_file(uploaded_file)
+            if file_type == FILE_TYPE_AUTO: file_type = detected_file_type(sniffed)
+            if (engine or choose_csv_engine(sniffed['file_size'])) == CSV_ENGINE_ARROW: df = parse_text_file_arrow(uploaded_file, file_type, sniffed)
+            if df is None: df = parse_text_file_streaming(uploaded_file, file_type, sniffed=sniffed)
+
+        if df is None:
+            raise ValueError(f"ประเภทไฟล์ '{file_type}' ไม่รองรับหรือไม่สามารถประมวลผลได้")
+
+        df_final = df.dropna(subset=['DateTime', 'Total import kW demand'])
+        if df_final.empty: raise ValueError("ไม่พบข้อมูลที่ถูกต้องในไฟล์หลังการประมวลผล")
+        return compact_meter_frame(df_final.sort_values(by='DateTime').reset_index(drop=True))
+
+    except Exception as e:
+        raise ValueError(f"เกิดข้อผิดพลาดขณะประมวลผลข้อมูล: {e}")
+
+def compact_meter_frame(df):
+    """DataFrame ใหม่ที่มีเฉพาะ DateTime และ Demand แบบ float32 (คอลัมน์ที่คำนวณเพิ่ม เช่น kWh ไม่ถูกเก็บ) ไม่แก้ไข df เดิม"""
+    return df[['DateTime', 'Total import kW demand']].astype({'Total import kW demand': DEMAND_DTYPE})
+
+def parsed_cache_key(uploaded_file, file_type):
+    """แฮชเนื้อหาไฟล์ร่วมกับประเภทไฟล์ (อ่านทีละบล็อก ไม่คัดลอกทั้งไฟล์)"""
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(f"v{PARSED_CACHE_VERSION}|{file_type}|".encode('utf-8'))
+    uploaded_file.seek(0)
+    for block in iter(lambda: uploaded_file.read(1024 * 1024), b''): hasher.update(block)
+    uploaded_file.seek(0)
+    return hasher.hexdigest()
+
+def _parsed_cache_path(cache_key):
+    return os.path.join(PARSED_CACHE_DIR, f"{cache_key}.feather")
+
+def load_parsed_cache(cache_key):
+    """อ่านข้อมูลจากแคชแบบ memory-map คืน None หากไม่มีในแคช
+    คอลัมน์ของ DataFrame ชี้ไปที่ไฟล์ที่ map ไว้โดยตรง (ไม่คัดลอก) ทุก session/โปรเซสที่เปิดไฟล์เดียวกันจึงใช้ page cache ชุดเดียวกัน"""
+    path = _parsed_cache_path(cache_key)
+    try: table = feather.read_table(path, memory_map=True)
+    except (OSError, pa.ArrowInvalid): return None
+    try: os.utime(path)  # อัปเดตเวลาใช้งานล่าสุดสำหรับ LRU (แคชที่อ่านอย่างเดียวยังใช้ได้ แม้อัปเดตไม่ได้)
+    except OSError: pass
+    return table.to_pandas(split_blocks=True)
+
+def store_parsed_cache(cache_key, df):
+    """บันทึกข้อมูลลงแคช แล้วลบไฟล์ที่ไม่ได้ใช้นานที่สุดจนขนาดรวมไม่เกิน PARSED_CACHE_MAX_BYTES"""
+    try:
+        os.makedirs(PARSED_CACHE_DIR, exist_ok=True)
+        path = _parsed_cache_path(cache_key); tmp_path = f"{path}.{os.getpid()}.tmp"
+        feather.write_feather(df, tmp_path, compression='uncompressed', chunksize=max(len(df), 1))  # chunk เดียวต่อคอลัมน์จึงเปิดแบบ zero-copy ได้
+        os.replace(tmp_path, path)
+        evict_parsed_cache()
+    except OSError: pass
+
+def evict_parsed_cache(max_bytes=None):
+    max_bytes = PARSED_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    for entry in os.scandir(PARSED_CACHE_DIR):
+        if entry.name.endswith('.feather'):
+            stat = entry.stat(); entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes: break
+        try: os.remove(path); total_bytes -= size
+        except OSError: pass
+
+def load_meter_data(uploaded_file, file_type, cache_key=None):
+    """อ่านข้อมูลมิเตอร์จากแคชบนดิสก์ หากไม่พบจึงประมวลผลด้วย parse_data_file แล้วเก็บลงแคช
+    (แล้วเปิดจากแคชแบบ memory-map แทนข้อมูลที่เพิ่งแปลง หากบันทึกแคชไม่ได้จึงคืนข้อมูลที่แปลงไว้)"""
+    if uploaded_file is None: return None
+    cache_key = cache_key or parsed_cache_key(uploaded_file, file_type)
+    df = load_parsed_cache(cache_key)
+    if df is None:
+        df = parse_data_file(uploaded_file, file_type)
+        store_parsed_cache(cache_key, df)
+        mapped = load_parsed_cache(cache_key); df = df if mapped is None else mapped
+    return df
+
+class DatasetHandle:
+    """ตัวอ้างอิงข้อมูลใน DatasetRegistry ที่ session เก็บไว้ (แทนการเก็บ DataFrame เอง)
+    คืน reference เมื่อเรียก release() หรือเมื่อ handle ถูกเก็บกวาดพร้อม session"""
+    def __init__(self, registry, key):
+        self.registry = registry; self.key = key
+        self._finalizer = weakref.finalize(self, registry.release, key)
+
+    @property
+    def data(self):
+        return self.registry.get(self.key)
+
+    def release(self):
+        self._finalizer()
+
+class DatasetRegistry:
+    """ทะเบียนข้อมูลมิเตอร์ที่ใช้ร่วมกันทุก session ในโปรเซสเดียวกัน โดยใช้แฮชเนื้อหาไฟล์ (parsed_cache_key) เป็น key
+    นับ reference ต่อ key ข้อมูลที่ไม่มี session ใช้แล้วยังเก็บไว้ และถูกลบตามลำดับ LRU เมื่อขนาดรวมเกิน max_bytes
+    (ข้อมูลที่ยังมี session ใช้อยู่จะไม่ถูกลบ)"""
+    def __init__(self, max_bytes=DATASET_REGISTRY_MAX_BYTES):
+        self.max_bytes = max_bytes; self._entries = OrderedDict(); self._lock = threading.Lock()
+
+    def acquire(self, key, loader):
+        """คืน DatasetHandle ของ key (เรียก loader() เพื่ออ่านข้อมูลเฉพาะเมื่อยังไม่มีในทะเบียน)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None: entry['refs'] += 1; self._entries.move_to_end(key)
+        if entry is None:
+            data = loader()
+            with self._lock:
+                entry = self._entries.get(key)  # session อื่นอาจอ่านข้อมูลชุดเดียวกันเสร็จก่อน
+                if entry is None:
+                    entry = self._entries[key] = {'data': data, 'nbytes': int(data.memory_usage(index=False).sum()), 'refs': 0}
+                entry['refs'] += 1; self._entries.move_to_end(key)
+                self._evict()
+        return DatasetHandle(self, key)
+
+    def get(self, key):
+        with self._lock:
+            self._entries.move_to_end(key)
+            return self._entries[key]['data']
+
+    def release(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None: entry['refs'] = max(0, entry['refs'] - 1)
+            self._evict()
+
+    def _evict(self):
+        total_bytes = sum(entry['nbytes'] for entry in self._entries.values())
+        for key in [key for key, entry in self._entries.items() if entry['refs'] == 0]:
+            if total_bytes <= self.max_bytes: break
+            total_bytes -= self._entries.pop(key)['nbytes']
+
+    def stats(self):
+        """จำนวนชุดข้อมูล, reference และขนาดรวม (ไบต์) ในทะเบียน"""
+        with self._lock:
+            return {'datasets': len(self._entries), 'refs': sum(entry['refs'] for entry in self._entries.values()), 'nbytes': sum(entry['nbytes'] for entry in self._entries.values())}
+
+DATASET_REGISTRY = DatasetRegistry()
+
+def estimate_interval_hours(datetime_series):
+    """ช่วงเวลาระหว่างข้อมูล (ชั่วโมง) จากสองแถวแรก ใช้ 0.25 หากคำนวณไม่ได้"""
+    interval_hours = (datetime_series.iloc[1] - datetime_series.iloc[0]).total_seconds() / 3600.0 if len(datetime_series) > 1 else 0.25
+    if not (0 < interval_hours <= 24): interval_hours = 0.25
+    return interval_hours
+
+def _energy_intervals(datetime_series, max_gap_hours=MAX_GAP_HOURS):
+    """ช่วงเวลาที่ integrate_energy ใช้ (ข้อมูลต้องเรียงตามเวลาและมีอย่างน้อยหนึ่งแถว)
+    คืนค่า (mask แถวที่ไม่ซ้ำ, ช่วงห่างระหว่างแถวที่ไม่ซ้ำ (ชม.), ช่วงปกติ (ชม.), mask ช่องว่าง, ชั่วโมงที่แต่ละแถวที่ไม่ซ้ำเป็นตัวแทน)"""
+    ts = datetime_series.to_numpy()
+    keep = np.empty(len(ts), dtype=bool); keep[0] = True; np.not_equal(ts[1:], ts[:-1], out=keep[1:])
+    if not keep.all(): ts = ts[keep]
+    step_hours = np.diff(ts.view('i8')) / (np.timedelta64(1, 'h') / np.timedelta64(1, np.datetime_data(ts.dtype)[0]))
+    nominal_hours = float(np.median(step_hours)) if len(step_hours) else 0.25
+    if not (0 < nominal_hours <= 24): nominal_hours = 0.25
+    is_gap = step_hours > max(max_gap_hours, nominal_hours)
+    # แถวก่อนช่องว่างและแถวสุดท้ายคิดเท่ากับช่วงก่อนหน้า (หรือช่วงปกติหากไม่มี)
+    prev_hours = np.where(is_gap, nominal_hours, step_hours)
+    durations = np.append(np.where(is_gap, np.append(nominal_hours, prev_hours[:-1]), step_hours), prev_hours[-1] if len(prev_hours) else nominal_hours)
+    return keep, step_hours, nominal_hours, is_gap, durations
+
+def integrate_energy(datetime_series, demand_series, method=ENERGY_METHOD_LEFT, max_gap_hours=MAX_GAP_HOURS):
+    """แปลง kW เป็น kWh ต่อแถวจากช่วงเวลาจริงระหว่างแถว (ข้อมูลต้องเรียงตามเวลา)
+    แถวที่เวลาซ้ำกับแถวก่อนหน้าได้ 0 kWh, ช่วงห่างที่ยาวเกินช่วงปกติ (มัธยฐาน) และ max_gap_hours ถือเป็นข้อมูลขาดหาย
+    คืนค่า (kWh ต่อแถวเป็น ndarray, สถิติช่องว่างเป็น dict)"""
+    if method not in (ENERGY_METHOD_LEFT, ENERGY_METHOD_TRAPEZOID): raise ValueError(f"ไม่รู้จักวิธีคำนวณ: {method}")
+    kw = demand_series.to_numpy(dtype='float64')
+    if len(kw) == 0: return np.zeros(0), {'rows': 0, 'duplicates_removed': 0, 'nominal_interval_hours': 0.25, 'gaps': 0, 'missing_hours': 0.0, 'max_gap_hours': 0.0}
+    keep, step_hours, nominal_hours, is_gap, durations = _energy_intervals(datetime_series, max_gap_hours)
+    has_duplicates = not keep.all()
+    if has_duplicates: kw = kw[keep]
+    if method == ENERGY_METHOD_TRAPEZOID:
+        paired = np.append(~is_gap, False)
+        kw = np.where(paired, (kw + np.append(kw[1:], kw[-1])) * 0.5, kw)
+    if has_duplicates: kwh = np.zeros(len(keep)); kwh[keep] = kw * durations
+    else: kwh = kw * durations
+    gap_hours = step_hours[is_gap]
+    return kwh, {
+        'rows': len(keep), 'duplicates_removed': int(len(keep) - keep.sum()), 'nominal_interval_hours': nominal_hours,
+        'gaps': len(gap_hours), 'missing_hours': float((gap_hours - durations[:-1][is_gap]).sum()),
+        'max_gap_hours': float(step_hours.max()) if len(step_hours) else 0.0,
+    }
+
+def compute_kwh(df, method=ENERGY_METHOD_FIXED, max_gap_hours=MAX_GAP_HOURS):
+    """หน่วยไฟ (kWh) ต่อแถวของ df ตามวิธีที่เลือก คืนค่า (kWh, สถิติช่องว่าง หรือ None สำหรับวิธีเดิม)"""
+    if method == ENERGY_METHOD_FIXED:
+        return df['Total import kW demand'].astype('float64') * estimate_interval_hours(df['DateTime']), None
+    kwh, gap_stats = integrate_energy(df['DateTime'], df['Total import kW demand'], method, max_gap_hours)
+    return pd.Series(kwh, index=df.index), gap_stats
+
+def format_gap_stats(gap_stats):
+    """ข้อความสรุปข้อมูลซ้ำ/ขาดหาย (None หากข้อมูลครบ)"""
+    if not gap_stats or not (gap_stats['duplicates_removed'] or gap_stats['gaps']): return None
+    return (f"ข้อมูลเวลาซ้ำ {gap_stats['duplicates_removed']:,} แถว, ข้อมูลขาดหาย {gap_stats['gaps']:,} ช่วง "
+            f"รวม {gap_stats['missing_hours']:,.1f} ชม. (ยาวสุด {gap_stats['max_gap_hours']:,.1f} ชม.) ไม่นำมาคิดหน่วยไฟ")
+
+def slice_date_range(df, start_date, end_date):
+    """ตัดข้อมูลช่วงวันที่ start_date ถึง end_date (รวมทั้งวัน) จาก df ที่เรียงตาม DateTime แล้ว
+    ใช้ searchsorted หาขอบเขต จึงไม่ต้องสร้าง mask ทั้งคอลัมน์ และคืนค่าเป็น view ของแถวที่ต่อเนื่องกันโดยไม่คัดลอกข้อมูล"""
+    start = df['DateTime'].searchsorted(pd.Timestamp(start_date), side='left')
+    stop = df['DateTime'].searchsorted(pd.Timestamp(end_date) + pd.Timedelta(days=1), side='left')
+    return df.iloc[start:stop]
+
+def add_ev_load(df, ev_power_kw, ev_start_time, ev_end_time, ev_start_date, ev_end_date):
+    """คืน DataFrame ใหม่ที่บวกกำลังไฟ EV ในช่วงเวลาชาร์จ (ข้ามเที่ยงคืนได้) ภายในช่วงวันที่ที่เลือก"""
+    df_with_ev = df.copy()
+    time_series = df_with_ev['DateTime'].dt.time
+    date_series = df_with_ev['DateTime'].dt.date
+    time_mask = (time_series >= ev_start_time) | (time_series < ev_end_time) if ev_start_time > ev_end_time else (time_series >= ev_start_time) & (time_series < ev_end_time)
+    date_mask = (date_series >= ev_start_date) & (date_series <= ev_end_date)
+    df_with_ev.loc[time_mask & date_mask, 'Total import kW demand'] += ev_power_kw
+    return df_with_ev
+
+def row_energy_weights(datetime_series, energy_method=ENERGY_METHOD_FIXED, row_factors=(None,), max_gap_hours=MAX_GAP_HOURS):
+    """kWh ที่ได้จากกำลังไฟเพิ่ม 1 kW ในแต่ละแถว ตามวิธีคำนวณหน่วยไฟเดียวกับ compute_kwh (ใช้คิดหน่วยไฟของโหลดที่บวกเพิ่ม เช่น EV)
+    trapezoid แบ่งกำลังไฟของแถวครึ่งหนึ่งให้ช่วงของแถวก่อนหน้า จึงเป็น transpose ของการรวมแบบ trapezoid
+    row_factors: ตัวคูณต่อแถวของ kWh ตามแถวที่หน่วยนั้นถูกคิด (None = 1 เช่น mask ช่วง Peak หรืออัตรา Ft) คืน array (len(row_factors), แถว)"""
+    n = len(datetime_series)
+    factors = np.array([np.ones(n) if factor is None else np.asarray(factor, dtype='float64') for factor in row_factors]).reshape(len(row_factors), n)
+    if energy_method == ENERGY_METHOD_FIXED: return factors * estimate_interval_hours(datetime_series)
+    if energy_method not in (ENERGY_METHOD_LEFT, ENERGY_METHOD_TRAPEZOID): raise ValueError(f"ไม่รู้จักวิธีคำนวณ: {energy_method}")
+    weights = np.zeros((len(row_factors), n))
+    if n == 0: return weights
+    keep, _, _, is_gap, durations = _energy_intervals(datetime_series, max_gap_hours)
+    billed = factors[:, keep] * durations
+    if energy_method == ENERGY_METHOD_TRAPEZOID:
+        paired = np.append(~is_gap, False) * 0.5  # สัดส่วนของช่วงแถวนี้ที่มาจากกำลังไฟของแถวถัดไป
+        billed = billed * (1.0 - paired) + np.pad((billed * paired)[:, :-1], ((0, 0), (1, 0)))
+    weights[:, keep] = billed
+    return weights
+
+def sweep_ev_scenarios(df, customer_type_key, tariff_type_key, ev_powers_kw, ev_windows, ev_date_ranges, ft_mode=FT_MODE_PERIOD_END, energy_method=ENERGY_METHOD_FIXED):
+    """จำลอง EV ทุกคู่ (กำลังไฟ, ช่วงเวลาชาร์จ, ช่วงวันที่) ในครั้งเดียว
+    ev_windows เป็น list ของ (เวลาเริ่ม, เวลาสิ้นสุด) และ ev_date_ranges เป็น list ของ (วันเริ่ม, วันสิ้นสุด) แบบเดียวกับ add_ev_load
+    หน่วยไฟ/TOU/Ft ของข้อมูลฐานคำนวณครั้งเดียว แล้วหาชั่วโมงชาร์จของทุกกรณีด้วยการคูณเมทริกซ์ mask ช่วงเวลา x mask ช่วงวันที่
+    อัตราที่มีค่าความต้องการพลังไฟฟ้าคิด Demand สูงสุดรายเดือนใหม่ทุกกรณีด้วย max_demand_by_cycle (Demand ฐาน + กำลังไฟ EV ในช่วงชาร์จ)
+    คืน DataFrame เรียงตามค่าไฟ EV ต่อหน่วย (ถูกที่สุดก่อน)"""
+    if df is None or df.empty: raise ValueError("ไม่มีข้อมูลสำหรับคำนวณ")
+    df_base = df.copy(deep=False); df_base['kWh'] = compute_kwh(df_base, energy_method)[0]
+    base_bill = calculate_bill(df_base, customer_type_key, tariff_type_key, ft_mode)
+    if base_bill.get('error'): raise ValueError(base_bill['error'])
+
+    dt = df_base['DateTime']; dt_values = dt.to_numpy(dtype='datetime64[ns]')
+    days = dt_values.astype('datetime64[D]'); time_of_day_ns = (dt_values - days).astype('int64')
+    rate_structure = TARIFFS[customer_type_key][tariff_type_key]
+    demand_period = rate_structure['demand_period'] if 'demand_rate' in rate_structure else None
+    is_peak = (classify_tou_periods(dt) == 'Peak').to_numpy() if tariff_type_key == 'tou' or demand_period == DEMAND_PERIOD_PEAK else None
+    # kWh ต่อ kW EV ของแต่ละแถวถ่วงน้ำหนักแต่ละแบบ ตาม energy_method: รวม, เฉพาะ Peak, คูณอัตรา Ft
+    row_factors = [None, is_peak if tariff_type_key == 'tou' else np.zeros(len(dt_values))]
+    if ft_mode == FT_MODE_PRORATED: row_factors.append(np.nan_to_num(get_ft_rates(dt)))
+    row_weights = row_energy_weights(dt, energy_method, row_factors)
+
+    window_masks = np.empty((len(ev_windows), len(dt_values)))
+    for i, (ev_start_time, ev_end_time) in enumerate(ev_windows):
+        start_ns, end_ns = _time_to_ns(ev_start_time), _time_to_ns(ev_end_time)
+        in_window = (time_of_day_ns >= start_ns) | (time_of_day_ns < end_ns) if start_ns > end_ns else (time_of_day_ns >= start_ns) & (time_of_day_ns < end_ns)
+        window_masks[i] = in_window
+    date_masks = np.empty((len(ev_date_ranges), len(dt_values)))
+    for j, (ev_start_date, ev_end_date) in enumerate(ev_date_ranges):
+        date_masks[j] = (days >= np.datetime64(ev_start_date, 'D')) & (days <= np.datetime64(ev_end_date, 'D'))
+    ev_hours, ev_peak_hours, *ev_ft_hours = [(window_masks * weights) @ date_masks.T for weights in row_weights]
+
+    # หน่วยไฟ EV ของทุกกรณีเป็น array (ช่วงเวลา, ช่วงวันที่, กำลังไฟ) แล้วคิดค่าไฟทั้งหมดใน price_bills ครั้งเดียว
+    powers = np.asarray(ev_powers_kw, dtype=float)
+    ev_kwh = ev_hours[:, :, None] * powers; ev_peak_kwh = ev_peak_hours[:, :, None] * powers
+    total_kwh = base_bill['total_kwh'] + ev_kwh
+    ft_cost = base_bill['ft_cost'] + ev_ft_hours[0][:, :, None] * powers if ev_ft_hours else total_kwh * base_bill['applicable_ft_rate']
+    demand_kw = 0.0
+    if demand_period is not None:
+        # Demand สูงสุดไม่เป็นเชิงเส้นตามกำลังไฟ EV จึงคิดใหม่ทีละกรณี
+        base_demand = df_base['Total import kW demand'].to_numpy(dtype='float64'); demand_kw = np.empty(ev_kwh.shape)
+        for i, j, k in np.ndindex(*ev_kwh.shape):
+            df_ev = pd.DataFrame({'DateTime': dt, 'Total import kW demand': base_demand + powers[k] * (window_masks[i] * date_masks[j])})
+            demand_kw[i, j, k] = max_demand_by_cycle(df_ev, (demand_period,), is_peak=is_peak)[demand_period].sum()
+    bills = price_bills(
+        customer_type_key, tariff_type_key, total_kwh,
+        (base_bill['kwh_peak'] or 0.0) + ev_peak_kwh, (base_bill['kwh_off_peak'] or 0.0) + ev_kwh - ev_peak_kwh, ft_cost, demand_kw
+    )
+    ev_cost = bills['final_bill'] - base_bill['final_bill']
+    i, j, k = np.indices(ev_kwh.shape).reshape(3, -1)
+    rows = {
+        'ev_power_kw': powers[k], 'ev_start_time': [ev_windows[w][0] for w in i], 'ev_end_time': [ev_windows[w][1] for w in i],
+        'ev_start_date': [ev_date_ranges[d][0] for d in j], 'ev_end_date': [ev_date_ranges[d][1] for d in j],
+        'ev_kwh': ev_kwh.ravel(), 'ev_kwh_peak': ev_peak_kwh.ravel(), 'total_kwh': total_kwh.ravel(),
+        'final_bill': bills['final_bill'].ravel(), 'ev_cost': ev_cost.ravel(),
+        'ev_cost_per_kwh': np.divide(ev_cost, ev_kwh, out=np.full(ev_kwh.shape, np.nan), where=ev_kwh != 0).ravel()
+    }
+    result = pd.DataFrame(rows).sort_values(['ev_cost_per_kwh', 'ev_cost'], kind='stable', na_position='last', ignore_index=True)
+    result.insert(0, 'rank', np.arange(1, len(result) + 1))
+    return result
+
+def marginal_energy_rate(rate_structure, total_kwh):
+    """ค่าพลังงานของหน่วยถัดไป (บาท/kWh) เมื่อใช้ไปแล้ว total_kwh สำหรับอัตรา flat/tiered (None สำหรับ TOU)"""
+    if rate_structure['type'] == 'flat': return rate_structure['rate']
+    if rate_structure['type'] == 'tiered':
+        for tier in rate_structure['tiers']:
+            if total_kwh < tier['limit']: return tier['rate']
+        return rate_structure['tiers'][-1]['rate']
+    return None
+
+def schedule_ev_charging(df, customer_type_key, tariff_type_key, energy_kwh_per_session, charger_kw, plug_in_time, plug_out_time, ev_start_date, ev_end_date, ft_mode=FT_MODE_PERIOD_END, energy_method=ENERGY_METHOD_FIXED):
+    """จัดตารางชาร์จ EV ให้ได้ energy_kwh_per_session ต่อการเสียบชาร์จหนึ่งครั้งด้วยค่าไฟต่ำที่สุด
+    เสียบชาร์จทุกวันในช่วงวันที่ตั้งแต่ plug_in_time ถึง plug_out_time (ข้ามเที่ยงคืนได้) ชาร์จได้ไม่เกิน charger_kw
+    แต่ละช่วงเวลามีราคาต่อหน่วยตามอัตรา TOU (Peak/Off-Peak) หรืออัตราขั้นที่หน่วยถัดไปตกอยู่สำหรับอัตรา tiered
+    บวก Ft ของช่วงเวลานั้นเมื่อคิด Ft ตามงวด แล้วเติมช่วงที่ถูกที่สุดของแต่ละการเสียบชาร์จก่อน (greedy, เวลาเท่ากันเลือกช่วงที่เร็วกว่า)
+    พลังงานและราคาต่อหน่วยของการชาร์จแต่ละแถวคิดด้วย row_energy_weights ตาม energy_method เดียวกับที่ใช้คิดบิล
+    (trapezoid: ครึ่งหนึ่งของพลังงานคิดในช่วงของแถวก่อนหน้า)
+    อัตราที่มี demand_rate: ช่วงที่นับ Demand (ตาม demand_period) ชาร์จด้วยกำลังไฟเท่ากันทุกช่วงเพียงเท่าที่ช่วงที่ไม่นับ Demand ชาร์จไม่พอ
+    (เกลี่ยพลังงานทั่วช่วงเสียบชาร์จแทนการชาร์จเต็มกำลังซึ่งเพิ่ม Demand สูงสุดของเดือน)
+    คืนค่า (DataFrame ใหม่ที่บวกกำลังไฟ EV แล้วพร้อมคอลัมน์ kWh ตาม energy_method ใช้กับ calculate_bill ได้ทันที, สรุปผลการจัดตาราง dict)"""
+    try:
+        rate_structure = TARIFFS[customer_type_key][tariff_type_key]
+    except KeyError as e: raise ValueError(f"ไม่พบโครงสร้างอัตราค่าไฟฟ้าสำหรับ '{customer_type_key}'/'{tariff_type_key}': {e}")
+    df_with_ev = df.copy()
+    dt = df_with_ev['DateTime']; dt_values = dt.to_numpy(dtype='datetime64[ns]')
+    days = dt_values.astype('datetime64[D]'); time_of_day_ns = (dt_values - days).astype('int64')
+
+    # ราคาต่อหน่วยของช่วงเวลาแต่ละแถว: TOU ตาม Peak/Off-Peak, อัตราอื่นใช้อัตราของหน่วยถัดไป บวก Ft เมื่อคิดตามงวด
+    demand_period = rate_structure['demand_period'] if 'demand_rate' in rate_structure else None
+    if tariff_type_key == 'tou' or demand_period == DEMAND_PERIOD_PEAK: is_peak = (classify_tou_periods(dt) == 'Peak').to_numpy()
+    if tariff_type_key == 'tou':
+        row_price = np.where(is_peak, rate_structure['peak_rate'], rate_structure['off_peak_rate'])
+    else:
+        base_kwh = float(compute_kwh(df, energy_method)[0].sum())
+        row_price = np.full(len(dt_values), marginal_energy_rate(rate_structure, base_kwh))
+    if ft_mode == FT_MODE_PRORATED: row_price = row_price + np.nan_to_num(get_ft_rates(dt))
+    # kWh ต่อ kW ที่ชาร์จในแต่ละแถว และค่าพลังงานของ kWh เหล่านั้น (ตามแถวที่หน่วยถูกคิด)
+    row_hours, row_cost = row_energy_weights(dt, energy_method, [None, row_price])
+
+    # การเสียบชาร์จแต่ละครั้งระบุด้วยวันที่เสียบ ช่วงหลังเที่ยงคืนของรอบข้ามคืนเป็นของวันก่อนหน้า
+    plug_in_ns, plug_out_ns = _time_to_ns(plug_in_time), _time_to_ns(plug_out_time)
+    session_day = days.copy()
+    if plug_in_ns > plug_out_ns:
+        after_midnight = time_of_day_ns < plug_out_ns
+        in_window = (time_of_day_ns >= plug_in_ns) | after_midnight
+        session_day[after_midnight] -= np.timedelta64(1, 'D')
+    else:
+        in_window = (time_of_day_ns >= plug_in_ns) & (time_of_day_ns < plug_out_ns)
+    in_window &= (session_day >= np.datetime64(ev_start_date, 'D')) & (session_day <= np.datetime64(ev_end_date, 'D')) & (row_hours > 0)
+    rows = np.flatnonzero(in_window)
+    price = row_cost[rows] / row_hours[rows]
+
+    # เรียงตาม (การเสียบชาร์จ, ราคา, เวลา) แล้วเติมพลังงานสะสมภายในแต่ละการเสียบชาร์จ
+    sessions = session_day[rows].view('i8')
+    order = np.lexsort((rows, price, sessions)); rows = rows[order]; sessions = sessions[order]
+    capacity = charger_kw * row_hours[rows]
+    session_starts = np.flatnonzero(np.r_[True, sessions[1:] != sessions[:-1]]) if len(rows) else np.array([], dtype=int)
+    session_lengths = np.diff(np.r_[session_starts, len(rows)])
+    if demand_period is not None and len(rows):
+        # กำลังไฟเท่ากันต่ำสุดในช่วงที่นับ Demand ที่ยังชาร์จได้ครบ หลังใช้ช่วงที่ไม่นับ Demand เต็มกำลังแล้ว
+        counted = is_peak[rows] if demand_period == DEMAND_PERIOD_PEAK else np.ones(len(rows), dtype=bool)
+        free_kwh = np.add.reduceat(np.where(counted, 0.0, capacity), session_starts)
+        counted_hours = np.add.reduceat(np.where(counted, row_hours[rows], 0.0), session_starts)
+        cap_kw = np.clip(np.divide(energy_kwh_per_session - free_kwh, counted_hours, out=np.zeros(len(session_starts)), where=counted_hours > 0), 0.0, charger_kw)
+        capacity = np.where(counted, np.repeat(cap_kw, session_lengths) * row_hours[rows], capacity)
+    cum_capacity = np.cumsum(capacity)
+    filled_before = np.repeat(cum_capacity[session_starts] - capacity[session_starts], session_lengths)
+    allocated = np.clip(energy_kwh_per_session - (cum_capacity - filled_before - capacity), 0.0, capacity)
+    demand = df_with_ev['Total import kW demand'].to_numpy(dtype='float64', copy=True); demand[rows] += allocated / row_hours[rows]
+    df_with_ev['Total import kW demand'] = demand.astype(df['Total import kW demand'].dtype)
+    df_with_ev['kWh'] = compute_kwh(df_with_ev, energy_method)[0]
+
+    delivered = np.add.reduceat(allocated, session_starts) if len(rows) else np.array([])
+    short = delivered < energy_kwh_per_session - 1e-9
+    return df_with_ev, {
+        'sessions': len(session_starts), 'delivered_kwh': float(delivered.sum()),
+        'shortfall_kwh': float((energy_kwh_per_session - delivered[short]).sum()), 'short_sessions': int(short.sum()),
+    }
+
+def calculate_service_charge(total_kwh, rate_structure):
+    """คำนวณค่าบริการรายเดือนตาม tier ของหน่วยไฟที่ใช้"""
+    if 'service_charge_tiers' in rate_structure:
+        for tier in rate_structure['service_charge_tiers']:
+            if total_kwh <= tier['limit']:
+                return tier['rate']
+        return rate_structure['service_charge_tiers'][-1]['rate']
+    else:
+        return rate_structure['service_charge']
+
+def calculate_bill(df_processed, customer_type_key, tariff_type_key, ft_mode=FT_MODE_PERIOD_END):
+    rate_structure = TARIFFS.get(customer_type_key, {}).get(tariff_type_key, {})
+    statistics = bill_statistics(
+        df_processed, ft_mode, tou=tariff_type_key == 'tou', demand_periods=(rate_structure['demand_period'],) if 'demand_rate' in rate_structure else ()
+    )
+    return price_bill_from_statistics(statistics, customer_type_key, tariff_type_key)
+
+def bill_statistics(df_processed, ft_mode=FT_MODE_PERIOD_END, tou=True, demand_periods=DEMAND_PERIODS):
+    """สถิติที่พอสำหรับคิดค่าไฟทุกอัตราใน TARIFFS จากการอ่านข้อมูลรอบเดียว: หน่วยรวม/Peak/Off-Peak, ช่วงข้อมูล,
+    ค่า Ft ตามงวด (ft_mode='prorated') และผลรวม Demand สูงสุดรายเดือนของแต่ละช่วงเวลาคิด Demand
+    tou=False ข้ามการแยก Peak/Off-Peak และ demand_periods เลือกเฉพาะช่วงเวลาคิด Demand ที่ต้องใช้ (calculate_bill คิดเฉพาะที่อัตรานั้นใช้)"""
+    if df_processed is None or df_processed.empty: return {"error": "ไม่มีข้อมูลสำหรับคำนวณ"}
+    if ft_mode not in FT_MODES: return {"error": f"ไม่รู้จักรูปแบบการคิดค่า Ft '{ft_mode}'"}
+    dt = df_processed['DateTime']; kwh = df_processed['kWh']
+    statistics = {
+        'total_kwh': kwh.sum(), 'kwh_peak': None, 'kwh_off_peak': None, 'data_period_start': dt.iloc[0], 'data_period_end': dt.iloc[-1],
+        'prorated_ft_cost': None, 'demand_kw': {}, 'tou_warnings': [], 'warnings': [], 'error': None
+    }
+    is_peak = None
+    if tou or DEMAND_PERIOD_PEAK in demand_periods:
+        periods = classify_tou_periods(dt); is_peak = (periods == 'Peak').to_numpy()
+    if tou:
+        statistics['tou_warnings'] = tou_data_warnings(dt)
+        kwh_summary = kwh.groupby(periods, observed=True).sum()
+        statistics['kwh_peak'] = kwh_summary.get('Peak', 0.0); statistics['kwh_off_peak'] = kwh_summary.get('Off-Peak', 0.0) + kwh_summary.get('Unknown', 0.0)
+    if ft_mode == FT_MODE_PRORATED:
+        interval_ft_rates = get_ft_rates(dt)
+        missing_ft = np.isnan(interval_ft_rates)
+        if missing_ft.any():
+            statistics['warnings'].append(f"ไม่พบอัตรา Ft สำหรับ {dt[missing_ft].iloc[0].date()}, ใช้ค่า Ft=0.0 กับช่วงเวลาดังกล่าว")
+        statistics['prorated_ft_cost'] = float(np.dot(kwh.to_numpy(), np.nan_to_num(interval_ft_rates)))
+    if demand_periods:
+        statistics['demand_kw'] = {period: float(total) for period, total in max_demand_by_cycle(df_processed, demand_periods, is_peak=is_peak).sum().items()}
+    return statistics
+
+def price_bill_from_statistics(statistics, customer_type_key, tariff_type_key):
+    """คิดค่าไฟของอัตราหนึ่งจากผลของ bill_statistics หรือ summary_bill_statistics โดยไม่อ่านข้อมูลซ้ำ"""
+    if statistics.get('error'): return {"error": statistics['error']}
+    rate_structure = TARIFFS.get(customer_type_key, {}).get(tariff_type_key, {})
+    is_tou = tariff_type_key == 'tou'
+    if is_tou and statistics['kwh_peak'] is None: return {"error": "ไม่มีหน่วย Peak/Off-Peak สำหรับอัตรา TOU"}
+    return price_bill(
+        customer_type_key, tariff_type_key, statistics['total_kwh'], statistics['kwh_peak'] or 0.0, statistics['kwh_off_peak'] or 0.0,
+        statistics['data_period_start'], statistics['data_period_end'], statistics['prorated_ft_cost'],
+        (statistics['tou_warnings'] if is_tou else []) + statistics['warnings'],
+        statistics['demand_kw'][rate_structure['demand_period']] if 'demand_rate' in rate_structure else None
+    )
+
+def tariff_cost_matrix(statistics, customer_type_keys=None):
+    """คิดค่าไฟทุกคู่ (ประเภทผู้ใช้, อัตรา) ใน TARIFFS จากสถิติชุดเดียว (อ่านข้อมูลครั้งเดียวไม่ว่าจะมีกี่อัตรา)
+    คืน DataFrame หนึ่งแถวต่อคู่ เรียงตามค่าไฟสุทธิ แถวแรกคืออัตราที่ถูกที่สุด (customer_type_keys จำกัดประเภทผู้ใช้ที่พิจารณา)"""
+    rows = []
+    for customer_type_key in customer_type_keys or TARIFFS:
+        for tariff_type_key in TARIFFS[customer_type_key]:
+            bill = price_bill_from_statistics(statistics, customer_type_key, tariff_type_key)
+            if bill.get('error'): continue
+            rows.append({'customer_type': customer_type_key, 'tariff_type': tariff_type_key, **{key: bill[key] for key in TARIFF_MATRIX_COLUMNS}})
+    result = pd.DataFrame(rows, columns=['customer_type', 'tariff_type', *TARIFF_MATRIX_COLUMNS]).sort_values('final_bill', kind='stable', ignore_index=True)
+    result.insert(0, 'rank', np.arange(1, len(result) + 1))
+    return result
+
+def price_bill(customer_type_key, tariff_type_key, total_kwh, kwh_peak, kwh_off_peak, data_period_start_dt, data_period_end_dt, prorated_ft_cost=None, warning_messages=None, demand_kw=None):
+    """คิดค่าไฟจากหน่วยรวม/Peak/Off-Peak ที่สรุปไว้แล้ว (prorated_ft_cost=None หมายถึงใช้ Ft ของวันสุดท้าย)
+    demand_kw คือผลรวม Demand สูงสุดของแต่ละเดือน (kW) ใช้กับอัตราที่มี demand_rate เท่านั้น"""
+    warning_messages = list(warning_messages or [])
+    try:
+        rate_structure = TARIFFS[customer_type_key][tariff_type_key]
+    except KeyError as e: return {"error": f"ไม่พบโครงสร้างอัตราค่าไฟฟ้าสำหรับ '{customer_type_key}'/'{tariff_type_key}': {e}"}
+    
+    base_energy_cost = 0.0
+    if rate_structure['type'] == 'flat': base_energy_cost = total_kwh * rate_structure['rate']
+    elif rate_structure['type'] == 'tiered':
+        last_limit = 0
+        for tier in rate_structure['tiers']:
+            units_in_tier = max(0, min(total_kwh, tier['limit']) - last_limit); base_energy_cost += units_in_tier * tier['rate']; last_limit = tier['limit'];
+            if total_kwh <= tier['limit']: break
+    elif rate_structure['type'] == 'tou': base_energy_cost = (kwh_peak * rate_structure['peak_rate']) + (kwh_off_peak * rate_structure['off_peak_rate'])
+    
+    service_charge = calculate_service_charge(total_kwh, rate_structure)
+    demand_charge = (demand_kw or 0.0) * rate_structure.get('demand_rate', 0.0)
+    if prorated_ft_cost is not None:
+        ft_cost = prorated_ft_cost
+        applicable_ft_rate = ft_cost / total_kwh if total_kwh else 0.0
+    else:
+        applicable_ft_rate = get_ft_rate(data_period_end_dt)
+        if applicable_ft_rate is None:
+            warning_messages.append(f"ไม่พบอัตรา Ft สำหรับ {data_period_end_dt.date()}, ใช้ค่า Ft=0.0"); applicable_ft_rate = 0.0
+        ft_cost = total_kwh * applicable_ft_rate
+    total_before_vat = base_energy_cost + demand_charge + service_charge + ft_cost; vat_amount = total_before_vat * VAT_RATE; final_bill = total_before_vat + vat_amount
+    
+    return {
+        "total_kwh": total_kwh, "final_bill": final_bill, "base_energy_cost": base_energy_cost,
+        "service_charge": service_charge, "ft_cost": ft_cost, "total_before_vat": total_before_vat,
+        "vat_amount": vat_amount, "applicable_ft_rate": applicable_ft_rate,
+        "demand_kw": (demand_kw or 0.0) if 'demand_rate' in rate_structure else None, "demand_charge": demand_charge,
+        "kwh_peak": kwh_peak if tariff_type_key == 'tou' else None,
+        "kwh_off_peak": kwh_off_peak if tariff_type_key == 'tou' else None,
+        "data_period_start": data_period_start_dt.strftime('%Y-%m-%d %H:%M'),
+        "data_period_end": data_period_end_dt.strftime('%Y-%m-%d %H:%M'), "warnings": warning_messages, "error": None
+    }
+
+def energy_costs(customer_type_key, tariff_type_key, total_kwh, kwh_peak=None, kwh_off_peak=None):
+    """ค่าพลังงาน (ก่อนค่าบริการ/Ft/VAT) ของหลายบิลพร้อมกัน ให้ผลเท่ากับ price_bill ทีละบิล
+    tiered ใช้ searchsorted หาขั้นครั้งเดียว แล้วคิด ค่าสะสม ณ ต้นขั้น + หน่วยในขั้น x อัตรา"""
+    compiled = get_compiled_tariff(customer_type_key, tariff_type_key); total_kwh = np.asarray(total_kwh, dtype=float)
+    if compiled['type'] == 'flat': return total_kwh * compiled['rate']
+    if compiled['type'] == 'tiered':
+        units = np.maximum(total_kwh, 0.0)
+        tier = np.minimum(np.searchsorted(compiled['limits'], units, side='left'), len(compiled['limits']) - 1)
+        return compiled['cost_at_start'][tier] + (units - compiled['tier_starts'][tier]) * compiled['rates'][tier]
+    if compiled['type'] == 'tou': return np.asarray(kwh_peak, dtype=float) * compiled['peak_rate'] + np.asarray(kwh_off_peak, dtype=float) * compiled['off_peak_rate']
+    return np.zeros_like(total_kwh)
+
+def service_charges(customer_type_key, tariff_type_key, total_kwh):
+    """ค่าบริการรายเดือนของหลายบิลพร้อมกัน ให้ผลเท่ากับ calculate_service_charge ทีละบิล"""
+    compiled = get_compiled_tariff(customer_type_key, tariff_type_key); total_kwh = np.asarray(total_kwh, dtype=float)
+    if 'service_limits' not in compiled: return np.full(total_kwh.shape, float(compiled['service_charge']))
+    return compiled['service_rates'][np.minimum(np.searchsorted(compiled['service_limits'], total_kwh, side='left'), len(compiled['service_limits']) - 1)]
+
+def price_bills(customer_type_key, tariff_type_key, total_kwh, kwh_peak, kwh_off_peak, ft_cost, demand_kw=0.0):
+    """คิดค่าไฟหลายบิลพร้อมกันจาก array ของหน่วยรวม/Peak/Off-Peak, ค่า Ft และ Demand สูงสุดรวม (kW) คืน dict ของ array แบบเดียวกับ price_bill"""
+    base_energy_cost = energy_costs(customer_type_key, tariff_type_key, total_kwh, kwh_peak, kwh_off_peak)
+    service_charge = service_charges(customer_type_key, tariff_type_key, total_kwh)
+    demand_charge = np.asarray(demand_kw, dtype=float) * get_compiled_tariff(customer_type_key, tariff_type_key)['demand_rate']
+    total_before_vat = base_energy_cost + demand_charge + service_charge + ft_cost; vat_amount = total_before_vat * VAT_RATE
+    return {
+        "total_kwh": np.asarray(total_kwh, dtype=float), "final_bill": total_before_vat + vat_amount, "base_energy_cost": base_energy_cost,
+        "service_charge": service_charge, "ft_cost": np.asarray(ft_cost, dtype=float), "total_before_vat": total_before_vat, "vat_amount": vat_amount,
+        "demand_charge": demand_charge,
+    }
+
+def billing_cycle_starts(datetime_series, read_day=1):
+    """วันเริ่มรอบบิลของแต่ละแถว (datetime64[D]) เมื่อจดมิเตอร์ทุกวันที่ read_day ของเดือน
+    เดือนที่สั้นกว่า read_day ใช้วันสุดท้ายของเดือนแทน"""
+    if not 1 <= read_day <= 31: raise ValueError(f"วันจดมิเตอร์ต้องอยู่ระหว่าง 1-31: {read_day}")
+    days = datetime_series.to_numpy(dtype='datetime64[ns]').astype('datetime64[D]')
+    if len(days) == 0: return days
+
+    def read_date(month):
+        month_length = ((month + 1).astype('datetime64[D]') - month.astype('datetime64[D]')).astype('int64')
+        return month.astype('datetime64[D]') + (np.minimum(read_day, month_length) - 1)
+
+    # คำนวณครั้งเดียวต่อวันในช่วงข้อมูล แล้วเปิดตารางด้วยเลขวันของแต่ละแถว
+    first_day = days.min(); calendar_days = np.arange(first_day, days.max() + 1)
+    months = calendar_days.astype('datetime64[M]')
+    cycle_months = months - (calendar_days < read_date(months)).astype('int64')
+    return read_date(cycle_months)[(days - first_day).astype('int64')]
+
+def calculate_cycle_bills(df_processed, customer_type_key, tariff_type_key, read_day=1, ft_mode=FT_MODE_PERIOD_END):
+    """แยกข้อมูลเป็นรอบบิลรายเดือนตามวันจดมิเตอร์แล้วคิดค่าไฟแต่ละรอบ (ขั้นอัตรา/ค่าบริการ/Ft แยกตามรอบ)
+    df_processed ต้องมีคอลัมน์ kWh แล้ว สรุปทุกรอบด้วย groupby ครั้งเดียว คืนค่า (DataFrame หนึ่งแถวต่อรอบ, ข้อความเตือน)"""
+    if df_processed is None or df_processed.empty: raise ValueError("ไม่มีข้อมูลสำหรับคำนวณ")
+    if ft_mode not in FT_MODES: raise ValueError(f"ไม่รู้จักรูปแบบการคิดค่า Ft '{ft_mode}'")
+    dt = df_processed['DateTime']; kwh = df_processed['kWh'].to_numpy(dtype=float)
+    warning_messages = []
+    per_row = {'kWh': kwh, 'DateTime': dt.to_numpy()}
+    if tariff_type_key == 'tou':
+        warning_messages.extend(tou_data_warnings(dt))
+        per_row['kwh_peak'] = np.where((classify_tou_periods(dt) == 'Peak').to_numpy(), kwh, 0.0)
+    if ft_mode == FT_MODE_PRORATED:
+        interval_ft_rates = get_ft_rates(dt)
+        if np.isnan(interval_ft_rates).any():
+            warning_messages.append(f"ไม่พบอัตรา Ft สำหรับ {dt[np.isnan(interval_ft_rates)].iloc[0].date()}, ใช้ค่า Ft=0.0 กับช่วงเวลาดังกล่าว")
+        per_row['ft_cost'] = kwh * np.nan_to_num(interval_ft_rates)
+    cycles = pd.DataFrame(per_row).groupby(pd.Index(billing_cycle_starts(dt, read_day), name='cycle_start')).agg(
+        rows=('kWh', 'size'), total_kwh=('kWh', 'sum'), data_period_start=('DateTime', 'first'), data_period_end=('DateTime', 'last'),
+        **{col: (col, 'sum') for col in ('kwh_peak', 'ft_cost') if col in per_row}
+    )
+
+    total_kwh = cycles['total_kwh'].to_numpy()
+    kwh_peak = cycles['kwh_peak'].to_numpy() if 'kwh_peak' in cycles else np.zeros(len(cycles))
+    if ft_mode == FT_MODE_PRORATED:
+        ft_cost = cycles['ft_cost'].to_numpy()
+        applicable_ft_rate = np.divide(ft_cost, total_kwh, out=np.zeros(len(cycles)), where=total_kwh != 0)
+    else:
+        cycle_ft_rates = get_ft_rates(cycles['data_period_end'])
+        for missing_end in cycles['data_period_end'][np.isnan(cycle_ft_rates)]:
+            warning_messages.append(f"ไม่พบอัตรา Ft สำหรับ {missing_end.date()}, ใช้ค่า Ft=0.0")
+        applicable_ft_rate = np.nan_to_num(cycle_ft_rates); ft_cost = total_kwh * applicable_ft_rate
+    rate_structure = TARIFFS[customer_type_key][tariff_type_key]
+    demand_kw = max_demand_by_cycle(df_processed, (rate_structure['demand_period'],), read_day)[rate_structure['demand_period']].to_numpy() if 'demand_rate' in rate_structure else np.full(len(cycles), np.nan)
+    bills = price_bills(customer_type_key, tariff_type_key, total_kwh, kwh_peak, total_kwh - kwh_peak, ft_cost, np.nan_to_num(demand_kw))
+
+    cycle_starts = cycles.index.to_numpy(dtype='datetime64[D]')
+    next_cycle_starts = billing_cycle_starts(pd.Series((cycle_starts.astype('datetime64[M]') + 1).astype('datetime64[D]') + (read_day - 1)), read_day)
+    result = pd.DataFrame({
+        'cycle_start': cycle_starts, 'cycle_end': next_cycle_starts - np.timedelta64(1, 'D'),
+        'data_period_start': cycles['data_period_start'].to_numpy(), 'data_period_end': cycles['data_period_end'].to_numpy(), 'rows': cycles['rows'].to_numpy(),
+        'total_kwh': total_kwh, 'kwh_peak': kwh_peak if tariff_type_key == 'tou' else np.nan,
+        'kwh_off_peak': total_kwh - kwh_peak if tariff_type_key == 'tou' else np.nan, 'demand_kw': demand_kw,
+        'base_energy_cost': bills['base_energy_cost'], 'demand_charge': np.where(np.isnan(demand_kw), np.nan, bills['demand_charge']), 'service_charge': bills['service_charge'], 'applicable_ft_rate': applicable_ft_rate,
+        'ft_cost': bills['ft_cost'], 'total_before_vat': bills['total_before_vat'], 'vat_amount': bills['vat_amount'], 'final_bill': bills['final_bill'],
+    })
+    return result, warning_messages
+
+def rolling_demand(datetime_series, demand_series, window_minutes=DEMAND_WINDOW_MINUTES):
+    """Demand เฉลี่ย (kW) ในช่วง window_minutes นาทีที่สิ้นสุด ณ แต่ละแถว (ช่วง (t - window, t]) ด้วย rolling ตามเวลา O(n)
+    ข้อมูลราย 15 นาทีได้ค่าของแถวนั้นเอง ข้อมูลที่ละเอียดกว่า (เช่น ราย 1 นาที) ได้ค่าเฉลี่ยของแถวในช่วง ข้อมูลต้องเรียงตามเวลา"""
+    demand = pd.Series(np.asarray(demand_series, dtype='float64'), index=pd.DatetimeIndex(datetime_series.to_numpy(dtype='datetime64[ns]')))
+    return demand.rolling(f'{window_minutes}min').mean().to_numpy()
+
+def max_demand_by_cycle(df, demand_periods=DEMAND_PERIODS, read_day=1, window_minutes=DEMAND_WINDOW_MINUTES, is_peak=None):
+    """ความต้องการพลังไฟฟ้าสูงสุด (kW) ของแต่ละรอบบิล คือค่าสูงสุดของ rolling_demand ในรอบนั้น
+    คอลัมน์ 'peak' นับเฉพาะแถวในช่วง Peak, 'all' นับทุกแถว (รอบที่ไม่มีแถวที่นับได้ 0 kW) คำนวณ rolling ครั้งเดียวให้ทุกคอลัมน์
+    หาค่าสูงสุดของทุกรอบด้วย maximum.reduceat คืน DataFrame index=cycle_start แบบเดียวกับ calculate_cycle_bills
+    is_peak ส่ง mask ช่วง Peak ที่คำนวณไว้แล้วมาใช้ซ้ำได้"""
+    for period in demand_periods:
+        if period not in DEMAND_PERIODS: raise ValueError(f"ไม่รู้จักช่วงเวลาคิด Demand '{period}'")
+    dt = df['DateTime']
+    if len(dt) == 0: return pd.DataFrame({period: [] for period in demand_periods}, index=pd.DatetimeIndex([], name='cycle_start'), dtype=float)
+    demand = np.maximum(rolling_demand(dt, df['Total import kW demand'], window_minutes), 0.0)
+    if DEMAND_PERIOD_PEAK in demand_periods and is_peak is None: is_peak = (classify_tou_periods(dt) == 'Peak').to_numpy()
+    cycle_starts = billing_cycle_starts(dt, read_day)
+    starts = np.flatnonzero(np.r_[True, cycle_starts[1:] != cycle_starts[:-1]])
+    return pd.DataFrame(
+        {period: np.maximum.reduceat(np.where(is_peak, demand, 0.0) if period == DEMAND_PERIOD_PEAK else demand, starts) for period in demand_periods},
+        index=pd.DatetimeIndex(cycle_starts[starts], name='cycle_start')
+    )
+
+def build_daily_tou_summary(df):
+    """สรุปผลรวม Demand (kW) รายวันแยก Peak/Off-Peak พร้อมเวลาแถวแรก/แถวที่สอง/แถวสุดท้ายของวัน
+    และ Demand เฉลี่ย 15 นาทีสูงสุดของวัน (ทั้งวัน/เฉพาะ Peak) สำหรับอัตราที่มีค่าความต้องการพลังไฟฟ้า
+    คอลัมน์ *_in_day ใช้เฉพาะหน้าต่างที่ไม่ย้อนไปก่อนเที่ยงคืน สำหรับวันแรกของช่วงวันที่ (ข้อมูลดิบที่ตัดช่วงไม่มีแถวของวันก่อนหน้า)
+    คำนวณครั้งเดียวต่อชุดข้อมูล แล้วใช้กับ calculate_bill_from_summary ได้ทุกช่วงวันที่/ประเภทผู้ใช้/อัตรา"""
+    dt = df['DateTime']; demand = df['Total import kW demand'].astype('float64')
+    days = dt.dt.normalize().rename('Date')
+    is_peak = (classify_tou_periods(dt) == 'Peak').to_numpy()
+    window_demand = rolling_demand(dt, demand)
+    # เลื่อนเวลาของแต่ละวันออกไปอีกวันละ 1 วัน ช่องห่างระหว่างวันจึงยาวกว่าหน้าต่าง และหน้าต่างไม่ข้ามเที่ยงคืน
+    day_values = days.to_numpy(dtype='datetime64[ns]')
+    day_offsets = (day_values - day_values[0]) if len(day_values) else np.zeros(0, dtype='timedelta64[ns]')
+    in_day_demand = rolling_demand(pd.Series(dt.to_numpy(dtype='datetime64[ns]') + day_offsets), demand)
+    per_row = pd.DataFrame({
+        'peak_kw_sum': demand.where(is_peak, 0.0), 'off_peak_kw_sum': demand.where(~is_peak, 0.0), 'DateTime': dt,
+        'max_demand_kw': window_demand, 'max_peak_demand_kw': np.where(is_peak, window_demand, 0.0),
+        'max_demand_kw_in_day': in_day_demand, 'max_peak_demand_kw_in_day': np.where(is_peak, in_day_demand, 0.0)
+    }, index=dt.index)
+    summary = per_row.groupby(days).agg(
+        peak_kw_sum=('peak_kw_sum', 'sum'), off_peak_kw_sum=('off_peak_kw_sum', 'sum'),
+        rows=('DateTime', 'size'), first_dt=('DateTime', 'first'), last_dt=('DateTime', 'last'),
+        max_demand_kw=('max_demand_kw', 'max'), max_peak_demand_kw=('max_peak_demand_kw', 'max'),
+        max_demand_kw_in_day=('max_demand_kw_in_day', 'max'), max_peak_demand_kw_in_day=('max_peak_demand_kw_in_day', 'max')
+    )
+    row_in_day = dt.groupby(days).cumcount().to_numpy()
+    summary['second_dt'] = pd.Series(dt[row_in_day == 1].to_numpy(), index=days[row_in_day == 1]).reindex(summary.index)
+    return summary
+
+def calculate_bill_from_summary(daily_summary, start_date, end_date, customer_type_key, tariff_type_key, ft_mode=FT_MODE_PERIOD_END):
+    """คำนวณค่าไฟของช่วงวันที่จากตารางสรุปรายวัน ให้ผลเท่ากับ calculate_bill บนข้อมูลดิบช่วงเดียวกัน (ไม่รวม EV)"""
+    return price_bill_from_statistics(summary_bill_statistics(daily_summary, start_date, end_date, ft_mode), customer_type_key, tariff_type_key)
+
+def summary_bill_statistics(daily_summary, start_date, end_date, ft_mode=FT_MODE_PERIOD_END):
+    """สถิติแบบเดียวกับ bill_statistics ของช่วงวันที่ จากตารางสรุปรายวัน (build_daily_tou_summary) โดยไม่สแกนข้อมูลดิบ"""
+    if ft_mode not in FT_MODES: return {"error": f"ไม่รู้จักรูปแบบการคิดค่า Ft '{ft_mode}'"}
+    rows = daily_summary.loc[pd.Timestamp(start_date):pd.Timestamp(end_date)]
+    if rows.empty: return {"error": "ไม่มีข้อมูลสำหรับคำนวณ"}
+    first_day = rows.iloc[0]
+    second_dt = first_day['second_dt'] if pd.notna(first_day['second_dt']) else (rows['first_dt'].iloc[1] if len(rows) > 1 else None)
+    interval_hours = estimate_interval_hours(pd.Series([first_day['first_dt'], second_dt] if second_dt is not None else [first_day['first_dt']]))
+
+    day_kwh = (rows['peak_kw_sum'] + rows['off_peak_kw_sum']).to_numpy() * interval_hours
+    statistics = {
+        'total_kwh': float(day_kwh.sum()), 'kwh_peak': float(rows['peak_kw_sum'].sum() * interval_hours), 'kwh_off_peak': float(rows['off_peak_kw_sum'].sum() * interval_hours),
+        'data_period_start': rows['first_dt'].iloc[0], 'data_period_end': rows['last_dt'].iloc[-1], 'prorated_ft_cost': None,
+        'tou_warnings': tou_data_warnings(rows['first_dt']), 'warnings': [], 'error': None
+    }
+    if ft_mode == FT_MODE_PRORATED:
+        day_ft_rates = get_ft_rates(rows['first_dt'])
+        missing_ft = np.isnan(day_ft_rates)
+        if missing_ft.any():
+            statistics['warnings'].append(f"ไม่พบอัตรา Ft สำหรับ {rows['first_dt'][missing_ft].iloc[0].date()}, ใช้ค่า Ft=0.0 กับช่วงเวลาดังกล่าว")
+        statistics['prorated_ft_cost'] = float(np.dot(day_kwh, np.nan_to_num(day_ft_rates)))
+    months = rows.index.to_numpy().astype('datetime64[M]')
+    statistics['demand_kw'] = {}
+    for period, column in ((DEMAND_PERIOD_PEAK, 'max_peak_demand_kw'), (DEMAND_PERIOD_ALL, 'max_demand_kw')):
+        day_max = rows[column].to_numpy(dtype='float64', copy=True); day_max[0] = rows[f'{column}_in_day'].iloc[0]  # วันแรกไม่นับแถวก่อน start_date
+        statistics['demand_kw'][period] = float(pd.Series(np.maximum(day_max, 0.0)).groupby(months).max().sum())
+    return statistics
+
+def get_ft_rate(date_in_period):
+    """อัตรา Ft ของงวดที่ครอบคลุมวันที่ คืน None หากไม่มีข้อมูลงวดนั้น"""
+    d = date_in_period.date() if isinstance(date_in_period, datetime) else date_in_period
+    period_start_dates, _, rates = get_ft_rate_index()
+    pos = bisect.bisect_right(period_start_dates, d) - 1
+    return float(rates[pos]) if pos >= 0 else None
+
+def get_ft_rates(datetime_series):
+    """อัตรา Ft ที่มีผล ณ แต่ละเวลาในคอลัมน์ (NaN หากไม่มีข้อมูลงวดนั้น)"""
+    _, period_starts, rates = get_ft_rate_index()
+    days = pd.to_datetime(datetime_series).to_numpy(dtype='datetime64[ns]').astype('datetime64[D]')
+    pos = np.searchsorted(period_starts, days, side='right') - 1
+    return np.where(pos >= 0, rates[np.maximum(pos, 0)], np.nan)
+
+def classify_tou_period(dt_obj):
+    if not isinstance(dt_obj, datetime): return 'Unknown'
+    current_date = dt_obj.date(); current_time = dt_obj.time()
+    if is_offpeak_day(np.datetime64(current_date, 'D'))[()]: return 'Off-Peak'
+    return 'Peak' if PEAK_START <= current_time <= PEAK_END else 'Off-Peak'
+
+def _time_to_ns(t):
+    return ((t.hour * 60 + t.minute) * 60 + t.second) * 1_000_000_000 + t.microsecond * 1000
+
+PEAK_START_NS = _time_to_ns(PEAK_START); PEAK_END_NS = _time_to_ns(PEAK_END)
+TOU_LABELS = np.array(['Off-Peak', 'Peak', 'Unknown'], dtype=object)
+TOU_PERIOD_DTYPE = pd.CategoricalDtype(TOU_LABELS)
+
+def tou_data_warnings(datetime_series):
+    """ข้อความเตือนเกี่ยวกับข้อมูลวันหยุด TOU ของปีที่อยู่ในช่วงข้อมูล (ปีที่ไม่มีข้อมูล หรือวันที่ในรายการผิดรูปแบบ)"""
+    messages = []
+    for year in sorted(pd.to_datetime(datetime_series, errors='coerce').dropna().dt.year.unique()):
+        year_holidays = get_tou_holidays(int(year))
+        if year_holidays is None: messages.append(f"ไม่พบข้อมูลวันหยุด TOU ปี {year}")
+        else: messages.extend(f"รูปแบบวันที่ไม่ถูกต้องในรายการวันหยุด: {d_str}" for d_str in year_holidays[1])
+    return messages
+
+def classify_tou_periods(datetime_series):
+    """จำแนก Peak/Off-Peak ทั้งคอลัมน์ DateTime ในครั้งเดียว (ผลลัพธ์เหมือน classify_tou_period ทุกแถว)
+    คืนค่าเป็น Series แบบ categorical (1 ไบต์ต่อแถว)"""
+    dt_values = pd.to_datetime(datetime_series, errors='coerce').to_numpy(dtype='datetime64[ns]')
+    valid = ~np.isnat(dt_values)
+    days = dt_values.astype('datetime64[D]')
+    time_of_day_ns = (dt_values - days).astype('int64')
+    is_peak_time = (time_of_day_ns >= PEAK_START_NS) & (time_of_day_ns <= PEAK_END_NS)
+
+    is_holiday = is_offpeak_day(days)
+
+    codes = np.where(valid, (is_peak_time & ~is_holiday).astype(np.int8), np.int8(2))
+    index = datetime_series.index if isinstance(datetime_series, pd.Series) else None
+    return pd.Series(pd.Categorical.from_codes(codes, dtype=TOU_PERIOD_DTYPE), index=index, name='TOU_Period')
+
+# ==============================================================================
+# --- ข้อมูลสำหรับกราฟ ---
+# ==============================================================================
+def downsample_minmax_indices(values, max_points=CHART_MAX_POINTS):
+    """ตำแหน่งแถวที่เก็บไว้เมื่อแบ่งข้อมูลเป็น max_points/2 ช่วงเท่าๆ กัน แล้วเลือกจุดต่ำสุดและสูงสุดของแต่ละช่วง (เรียงตามเวลา)"""
+    n = len(values)
+    if n <= max_points: return np.arange(n)
+    bucket_size = -(-n // max(1, max_points // 2)); n_full = (n // bucket_size) * bucket_size
+    lows = np.where(np.isnan(values), np.inf, values); highs = np.where(np.isnan(values), -np.inf, values)
+    offsets = np.arange(0, n_full, bucket_size)
+    lo = offsets + np.argmin(lows[:n_full].reshape(-1, bucket_size), axis=1); hi = offsets + np.argmax(highs[:n_full].reshape(-1, bucket_size), axis=1)
+    picked = np.column_stack([np.minimum(lo, hi), np.maximum(lo, hi)]).ravel()
+    if n_full < n:
+        picked = np.r_[picked, n_full + np.sort([np.argmin(lows[n_full:]), np.argmax(highs[n_full:])])]
+    return picked[np.r_[True, picked[1:] != picked[:-1]]]
+
+def downsample_lttb_indices(x, y, max_points=CHART_MAX_POINTS):
+    """ตำแหน่งแถวที่เลือกด้วย Largest-Triangle-Three-Buckets: เก็บจุดแรก/สุดท้าย แล้วเลือกจุดละหนึ่งจุดต่อช่วง
+    ที่ทำให้สามเหลี่ยมกับจุดที่เลือกก่อนหน้าและค่าเฉลี่ยของช่วงถัดไปมีพื้นที่มากที่สุด"""
+    n = len(y)
+    if n <= max_points or max_points < 3: return np.arange(n)
+    edges = np.linspace(1, n - 1, max_points - 1).astype(np.int64)
+    # ค่าเฉลี่ยของแต่ละช่วงคำนวณครั้งเดียวด้วย cumsum
+    cum_x = np.r_[0.0, np.cumsum(x)]; cum_y = np.r_[0.0, np.cumsum(y)]
+    counts = np.diff(edges)
+    avg_x = np.r_[(cum_x[edges[1:]] - cum_x[edges[:-1]]) / counts, x[-1]]; avg_y = np.r_[(cum_y[edges[1:]] - cum_y[edges[:-1]]) / counts, y[-1]]
+    picked = np.empty(max_points, dtype=np.int64); picked[0] = 0; picked[-1] = n - 1; a = 0
+    for b in range(max_points - 2):
+        start, stop = edges[b], edges[b + 1]
+        area = np.abs((x[a] - avg_x[b + 1]) * (y[start:stop] - y[a]) - (x[a] - x[start:stop]) * (avg_y[b + 1] - y[a]))
+        a = start + int(np.argmax(area)); picked[b + 1] = a
+    return picked
+
+def downsample_series(datetime_series, value_series, max_points=CHART_MAX_POINTS, method=DOWNSAMPLE_MINMAX):
+    """ลดจำนวนจุดของเส้นกราฟให้ไม่เกิน max_points โดยคง Peak ไว้ คืน Series ที่มี DateTime เป็น index"""
+    if method not in DOWNSAMPLE_METHODS: raise ValueError(f"ไม่รู้จักวิธีลดจำนวนจุด: {method}")
+    values = value_series.to_numpy(dtype=float)
+    if method == DOWNSAMPLE_LTTB:
+        dt_values = datetime_series.to_numpy(dtype='datetime64[ns]').view('i8')
+        picked = downsample_lttb_indices((dt_values - dt_values[0]).astype(float) if len(dt_values) else dt_values.astype(float), np.nan_to_num(values), max_points)
+    else:
+        picked = downsample_minmax_indices(values, max_points)
+    return pd.Series(values[picked], index=pd.DatetimeIndex(datetime_series.to_numpy()[picked], name=datetime_series.name), name=value_series.name)
+
+def _pyramid_bucket_starts(dt_values, level):
+    """เวลาเริ่มของช่วงในระดับ level ของแต่ละเวลา (datetime64[ns])"""
+    if level == '1W':
+        days = dt_values.astype('datetime64[D]')
+        return (days - (days.view('i8') + 3) % 7).astype('datetime64[ns]')  # 1970-01-01 เป็นวันพฤหัสบดี
+    ticks = dt_values.view('i8')
+    return (ticks - ticks % PYRAMID_STEPS_NS[level]).view('datetime64[ns]')
+
+def _reduce_sorted_buckets(bucket_starts, columns):
+    """รวมข้อมูลที่เรียงตามเวลาแล้วเป็นช่วงด้วย reduceat (O(n)) columns เป็น dict ชื่อคอลัมน์ -> (array, ufunc)"""
+    starts = np.flatnonzero(np.r_[True, bucket_starts[1:] != bucket_starts[:-1]])
+    frame = pd.DataFrame({name: ufunc.reduceat(values, starts) for name, (values, ufunc) in columns.items()},
+                         index=pd.DatetimeIndex(bucket_starts[starts], name='DateTime'))
+    frame['kw_mean'] = frame['kw_sum'] / frame['rows']
+    return frame
+
+def build_load_pyramid(df):
+    """สรุปข้อมูลสำหรับกราฟเป็นหลายระดับ (15 นาที, 1 ชั่วโมง, 1 วัน, 1 สัปดาห์) คำนวณครั้งเดียวต่อชุดข้อมูล
+    แต่ละระดับมี rows, kW (sum/mean/max/min), kWh รวม และแยก Peak (kWh, kW รวม, จำนวนแถว)
+    ระดับแรกสรุปจากข้อมูลดิบ ระดับถัดไปสรุปจากระดับก่อนหน้า จึงใช้เวลาเชิงเส้นกับจำนวนแถวเพียงครั้งเดียว"""
+    dt_values = df['DateTime'].to_numpy(dtype='datetime64[ns]')
+    kw = df['Total import kW demand'].to_numpy(dtype=float)
+    kwh = df['kWh'].to_numpy(dtype=float) if 'kWh' in df else kw * estimate_interval_hours(df['DateTime'])
+    is_peak = (classify_tou_periods(df['DateTime']) == 'Peak').to_numpy()
+    columns = {
+        'rows': (np.ones(len(kw), dtype=np.int64), np.add), 'kw_sum': (kw, np.add), 'kw_max': (kw, np.maximum), 'kw_min': (kw, np.minimum),
+        'kwh_sum': (kwh, np.add), 'kwh_peak': (np.where(is_peak, kwh, 0.0), np.add),
+        'kw_sum_peak': (np.where(is_peak, kw, 0.0), np.add), 'rows_peak': (is_peak.astype(np.int64), np.add),
+    }
+    pyramid = {}
+    if len(dt_values) == 0:
+        return {level: pd.DataFrame(columns=[*columns, 'kw_mean'], index=pd.DatetimeIndex([], name='DateTime')) for level in PYRAMID_LEVELS}
+    for level in PYRAMID_LEVELS:
+        pyramid[level] = _reduce_sorted_buckets(_pyramid_bucket_starts(dt_values, level), columns)
+        dt_values = pyramid[level].index.to_numpy()
+        columns = {name: (pyramid[level][name].to_numpy(), ufunc) for name, (_, ufunc) in columns.items()}
+    return pyramid
+
+def select_pyramid_level(pyramid, start, end, max_points=CHART_MAX_POINTS):
+    """ระดับที่ละเอียดที่สุดซึ่งมีจำนวนช่วงใน [start, end) ไม่เกิน max_points คืนค่า (ชื่อระดับ, DataFrame เฉพาะช่วง)
+    ใช้ searchsorted กับ index ของแต่ละระดับ จึงใช้เวลาตามจำนวนจุดที่แสดง ไม่ขึ้นกับจำนวนแถวดิบ"""
+    for level in PYRAMID_LEVELS:
+        frame = pyramid[level]
+        lo, hi = frame.index.searchsorted(pd.Timestamp(start)), frame.index.searchsorted(pd.Timestamp(end))
+        if hi - lo <= max_points or level == PYRAMID_LEVELS[-1]: return level, frame.iloc[lo:hi]
+
+# ==============================================================================
+# --- สถิติการใช้ไฟ ---
+# ==============================================================================
+class DemandStats:
+    """สถิติของ Demand (kW) จากการอ่านข้อมูลรอบเดียว รวมทีละ chunk หรือรวมกับ DemandStats อื่นได้
+    - ค่าเฉลี่ย/ส่วนเบี่ยงเบนมาตรฐานแบบ Welford (รวมแต่ละ chunk ด้วยสูตรของ Chan), ค่าต่ำสุด/สูงสุด
+    - quantile sketch แบบช่วงลอการิทึม (ค่าคลาดเคลื่อนสัมพัทธ์ไม่เกิน accuracy) สำหรับมัธยฐานและจำนวนข้อมูลที่เกิน percentile 90"""
+    def __init__(self, accuracy=STATS_SKETCH_ACCURACY):
+        self.accuracy = accuracy; self.log_gamma = np.log((1 + accuracy) / (1 - accuracy))
+        self.count = 0; self.mean = 0.0; self.m2 = 0.0; self.min = np.inf; self.max = -np.inf
+        self.zero_count = 0; self.positive_bins = {}; self.negative_bins = {}
+
+    @classmethod
+    def from_series(cls, value_series, chunk_rows=PARSE_CHUNK_ROWS):
+        stats = cls(); values = value_series.to_numpy(dtype=float)
+        for start in range(0, len(values), chunk_rows): stats.update(values[start:start + chunk_rows])
+        return stats
+
+    def _add_bins(self, bins, magnitudes):
+        if len(magnitudes) == 0: return
+        keys = np.ceil(np.log(magnitudes) / self.log_gamma).astype(np.int64); lowest = keys.min()
+        counts = np.bincount(keys - lowest)
+        for key in np.flatnonzero(counts): bins[int(key + lowest)] = bins.get(int(key + lowest), 0) + int(counts[key])
+
+    def update(self, values):
+        """เพิ่มข้อมูลหนึ่ง chunk (ไม่นับ NaN)"""
+        values = np.asarray(values, dtype=float); values = values[~np.isnan(values)]
+        if len(values) == 0: return self
+        n = len(values); chunk_mean = float(values.mean()); chunk_m2 = float(((values - chunk_mean) ** 2).sum())
+        total = self.count + n; delta = chunk_mean - self.mean
+        self.mean += delta * n / total; self.m2 += chunk_m2 + delta * delta * self.count * n / total; self.count = total
+        self.min = min(self.min, float(values.min())); self.max = max(self.max, float(values.max()))
+        self.zero_count += int((values == 0).sum())
+        self._add_bins(self.positive_bins, values[values > 0]); self._add_bins(self.negative_bins, -values[values < 0])
+        return self
+
+    def merge(self, other):
+        """รวมสถิติของ other เข้ากับชุดนี้ (ต้องใช้ accuracy เดียวกัน)"""
+        if other.count == 0: return self
+        total = self.count + other.count; delta = other.mean - self.mean
+        self.mean += delta * other.count / total; self.m2 += other.m2 + delta * delta * self.count * other.count / total; self.count = total
+        self.min = min(self.min, other.min); self.max = max(self.max, other.max); self.zero_count += other.zero_count
+        for bins, other_bins in ((self.positive_bins, other.positive_bins), (self.negative_bins, other.negative_bins)):
+            for key, n in other_bins.items(): bins[key] = bins.get(key, 0) + n
+        return self
+
+    def _sorted_bins(self):
+        """ค่าตัวแทน ขอบล่าง ขอบบน และจำนวนของทุกช่วง เรียงจากน้อยไปมาก"""
+        gamma = np.exp(self.log_gamma); parts = []
+        if self.negative_bins:
+            keys = np.array(sorted(self.negative_bins, reverse=True)); counts = np.array([self.negative_bins[k] for k in keys])
+            upper = gamma ** keys
+            parts.append((-2 * upper / (1 + gamma), -upper, -upper / gamma, counts))
+        if self.zero_count: parts.append((np.zeros(1), np.zeros(1), np.zeros(1), np.array([self.zero_count])))
+        if self.positive_bins:
+            keys = np.array(sorted(self.positive_bins)); counts = np.array([self.positive_bins[k] for k in keys])
+            upper = gamma ** keys
+            parts.append((2 * upper / (1 + gamma), upper / gamma, upper, counts))
+        return [np.concatenate(column) for column in zip(*parts)]
+
+    def quantile(self, q):
+        """ค่า quantile แบบเดียวกับ pandas (interpolation แบบ linear) จาก sketch"""
+        if self.count == 0: return np.nan
+        values, _, _, counts = self._sorted_bins(); cum = np.cumsum(counts)
+        rank = (self.count - 1) * q; lo, hi = int(np.floor(rank)), int(np.ceil(rank))
+        value_lo, value_hi = values[np.searchsorted(cum, lo, side='right')], values[np.searchsorted(cum, hi, side='right')]
+        return float(np.clip(value_lo + (value_hi - value_lo) * (rank - lo), self.min, self.max))
+
+    def count_above(self, threshold):
+        """จำนวนข้อมูลที่มากกว่า threshold (ช่วงที่คร่อม threshold คิดตามสัดส่วนของช่วง)"""
+        if self.count == 0: return 0
+        _, lower, upper, counts = self._sorted_bins()
+        lower, upper = np.maximum(lower, self.min), np.minimum(upper, self.max); width = upper - lower
+        share_above = np.where(width > 0, np.clip((upper - threshold) / np.where(width > 0, width, 1), 0, 1), (lower > threshold).astype(float))
+        return int(round(float((counts * share_above).sum())))
+
+    @property
+    def std(self):
+        return float(np.sqrt(self.m2 / (self.count - 1))) if self.count > 1 else np.nan
+
+    def as_dict(self):
+        """สถิติสำหรับแสดงผล (ชื่อคีย์เดียวกับรายงานสำหรับพิมพ์)"""
+        if self.count == 0: return {'max_demand': np.nan, 'min_demand': np.nan, 'avg_demand': np.nan, 'median_demand': np.nan, 'std_demand': np.nan,
+                                    'load_factor': np.nan, 'total_records': 0, 'p90_demand': np.nan, 'records_above_p90': 0}
+        p90 = self.quantile(0.9)
+        return {
+            'max_demand': self.max, 'min_demand': self.min, 'avg_demand': self.mean, 'median_demand': self.quantile(0.5),
+            'std_demand': self.std, 'load_factor': self.mean / self.max * 100 if self.max else np.nan,
+            'total_records': self.count, 'p90_demand': p90, 'records_above_p90': self.count_above(p90),
+        }
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""เทียบ calculate_bill_from_summary กับ calculate_bill บนข้อมูลดิบที่ตัดช่วงวันที่เดียวกัน (รวม Demand ที่ต่อจากวันก่อน start_date)
+
+    python -m unittest discover -s tests
+"""
+import unittest
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from electricity_core import TARIFFS, build_daily_tou_summary, calculate_bill, calculate_bill_from_summary, compute_kwh, slice_date_range
+
+def meter_frame(seed=0):
+    """ข้อมูลราย 1 นาที ม.ค.-มี.ค. 2024 ที่มี Demand สูงก่อนเที่ยงคืนของวันที่ 9 ก.พ."""
+    rng = np.random.default_rng(seed)
+    times = pd.date_range('2024-01-01', '2024-03-31 23:59', freq='1min')
+    demand = rng.uniform(0, 300, len(times))
+    demand[(times >= pd.Timestamp('2024-02-09 23:50')) & (times <= pd.Timestamp('2024-02-09 23:59'))] = 450.0
+    return pd.DataFrame({'DateTime': times, 'Total import kW demand': demand})
+
+class DailySummaryBillTests(unittest.TestCase):
+    def test_summary_matches_raw_slice(self):
+        df = meter_frame(); daily_summary = build_daily_tou_summary(df)
+        for start_date, end_date in ((date(2024, 2, 10), date(2024, 3, 31)), (date(2024, 1, 1), date(2024, 3, 31)), (date(2024, 2, 9), date(2024, 2, 10))):
+            df_range = slice_date_range(df, start_date, end_date).copy(); df_range['kWh'] = compute_kwh(df_range)[0]
+            for customer_type_key in TARIFFS:
+                for tariff_type_key in TARIFFS[customer_type_key]:
+                    with self.subTest(start=start_date, end=end_date, customer=customer_type_key, tariff=tariff_type_key):
+                        expected = calculate_bill(df_range, customer_type_key, tariff_type_key)
+                        actual = calculate_bill_from_summary(daily_summary, start_date, end_date, customer_type_key, tariff_type_key)
+                        self.assertAlmostEqual(actual['final_bill'], expected['final_bill'], places=6)
+                        if expected['demand_kw'] is not None: self.assertAlmostEqual(actual['demand_kw'], expected['demand_kw'], places=6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""ตรวจ schedule_ev_charging ทุกวิธีคำนวณหน่วยไฟใน ENERGY_METHODS: หน่วยที่ชาร์จได้ตรงกับหน่วย EV ในบิล และไม่ชาร์จในช่วง Peak เมื่อช่วง Off-Peak พอ
+
+    python -m unittest discover -s tests
+"""
+import unittest
+from datetime import date, time
+
+import numpy as np
+import pandas as pd
+
+from electricity_core import ENERGY_METHODS, calculate_bill, compute_kwh, schedule_ev_charging
+
+ENERGY_KWH_PER_SESSION = 20.0
+CHARGER_KW = 7.0
+PLUG_IN, PLUG_OUT = time(18, 0), time(7, 0)  # 22:00-07:00 เป็น Off-Peak ชาร์จได้ 63 kWh ต่อคืน
+EV_START_DATE, EV_END_DATE = date(2024, 3, 1), date(2024, 3, 31)
+
+def meter_frame(seed=0):
+    """ข้อมูลราย 15 นาทีเดือนมีนาคม 2024"""
+    rng = np.random.default_rng(seed)
+    times = pd.date_range('2024-03-01', '2024-03-31 23:45', freq='15min')
+    return pd.DataFrame({'DateTime': times, 'Total import kW demand': rng.uniform(0, 5, len(times))})
+
+class ScheduleEvChargingTests(unittest.TestCase):
+    def test_delivered_energy_and_peak_share_for_every_energy_method(self):
+        df = meter_frame()
+        for energy_method in ENERGY_METHODS:
+            for customer_type_key in ('residential', 'mb_mv'):
+                with self.subTest(energy_method=energy_method, customer=customer_type_key):
+                    df_base = df.copy(); df_base['kWh'] = compute_kwh(df_base, energy_method)[0]
+                    base_bill = calculate_bill(df_base, customer_type_key, 'tou')
+                    df_with_ev, schedule = schedule_ev_charging(
+                        df, customer_type_key, 'tou', ENERGY_KWH_PER_SESSION, CHARGER_KW, PLUG_IN, PLUG_OUT, EV_START_DATE, EV_END_DATE, energy_method=energy_method
+                    )
+                    ev_bill = calculate_bill(df_with_ev, customer_type_key, 'tou')
+                    self.assertEqual(schedule['short_sessions'], 0)
+                    self.assertAlmostEqual(schedule['delivered_kwh'], ENERGY_KWH_PER_SESSION * schedule['sessions'], places=6)
+                    self.assertAlmostEqual(ev_bill['total_kwh'] - base_bill['total_kwh'], schedule['delivered_kwh'], places=6)
+                    self.assertAlmostEqual(ev_bill['kwh_peak'] - base_bill['kwh_peak'], 0.0, places=6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""เทียบผลของ sweep_ev_scenarios ทุกแถวกับการคิดทีละกรณี (add_ev_load + compute_kwh + calculate_bill) ทุกวิธีคำนวณหน่วยไฟใน ENERGY_METHODS
+
+    python -m unittest discover -s tests
+"""
+import unittest
+from datetime import date, time
+
+import numpy as np
+import pandas as pd
+
+from electricity_core import ENERGY_METHODS, FT_MODES, add_ev_load, calculate_bill, compute_kwh, sweep_ev_scenarios
+
+EV_POWERS_KW = [3.7, 7.0]
+EV_WINDOWS = [(time(22, 0), time(5, 0)), (time(9, 0), time(16, 0))]
+EV_DATE_RANGES = [(date(2024, 3, 1), date(2024, 3, 31)), (date(2024, 3, 10), date(2024, 3, 20))]
+TARIFF_CASES = [('residential', 'tou'), ('residential', 'normal'), ('mb_mv', 'tou'), ('mb_mv', 'normal')]
+
+def meter_frame(seed=0):
+    """ข้อมูลราย 15 นาทีเดือนมีนาคม 2024 ที่มีช่องว่างและเวลาซ้ำ"""
+    rng = np.random.default_rng(seed)
+    times = pd.date_range('2024-03-01', '2024-03-31 23:45', freq='15min')
+    times = times.delete(np.r_[300:320]).append(times[[1000, 1001]]).sort_values()
+    return pd.DataFrame({'DateTime': times, 'Total import kW demand': rng.uniform(0, 20, len(times))})
+
+class SweepEvScenariosTests(unittest.TestCase):
+    def test_sweep_matches_single_scenario_for_every_energy_method(self):
+        df = meter_frame()
+        for energy_method in ENERGY_METHODS:
+            for customer_type_key, tariff_type_key in TARIFF_CASES:
+                for ft_mode in FT_MODES:
+                    sweep = sweep_ev_scenarios(df, customer_type_key, tariff_type_key, EV_POWERS_KW, EV_WINDOWS, EV_DATE_RANGES, ft_mode, energy_method)
+                    self.assertEqual(len(sweep), len(EV_POWERS_KW) * len(EV_WINDOWS) * len(EV_DATE_RANGES))
+                    for row in sweep.itertuples():
+                        with self.subTest(energy_method=energy_method, customer=customer_type_key, tariff=tariff_type_key, ft_mode=ft_mode, scenario=row.rank):
+                            df_with_ev = add_ev_load(df, row.ev_power_kw, row.ev_start_time, row.ev_end_time, row.ev_start_date, row.ev_end_date)
+                            df_with_ev['kWh'] = compute_kwh(df_with_ev, energy_method)[0]
+                            bill = calculate_bill(df_with_ev, customer_type_key, tariff_type_key, ft_mode)
+                            self.assertAlmostEqual(row.total_kwh, bill['total_kwh'], places=6)
+                            self.assertAlmostEqual(row.final_bill, bill['final_bill'], places=6)
+
+if __name__ == '__main__':
+    unittest.main()
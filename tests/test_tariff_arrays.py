@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""เทียบการคิดค่าไฟแบบ array (energy_costs / service_charges / price_bills) กับการคิดทีละบิลแบบเดิม (price_bill / calculate_service_charge)
+ครอบคลุมทุกอัตราใน TARIFFS: หน่วยสุ่ม, ขอบขั้นพอดี ± ε, 0, ค่าติดลบ และค่าขนาดใหญ่มาก
+
+    python -m unittest discover -s tests
+"""
+import unittest
+from datetime import datetime
+
+import numpy as np
+
+from electricity_core import TARIFFS, calculate_service_charge, energy_costs, price_bill, price_bills, service_charges
+
+EPSILON = 1e-6
+PERIOD_START, PERIOD_END = datetime(2024, 1, 1), datetime(2024, 1, 31, 23, 45)
+
+def tariff_pairs():
+    return [(customer_type_key, tariff_type_key) for customer_type_key in TARIFFS for tariff_type_key in TARIFFS[customer_type_key]]
+
+def tier_limits(rate_structure):
+    """ขอบขั้นที่มีค่าจำกัดทั้งหมดของอัตรา (ขั้นหน่วยไฟและขั้นค่าบริการ)"""
+    tiers = rate_structure.get('tiers', []) + rate_structure.get('service_charge_tiers', [])
+    return sorted({tier['limit'] for tier in tiers if np.isfinite(tier['limit'])})
+
+def sample_kwh(rate_structure, seed=0, n_random=500):
+    """หน่วยไฟสุ่ม 0-2,000 kWh รวมกับกรณีขอบ: 0, ±ε, ขอบขั้น ± ε, ค่าติดลบ และค่าขนาดใหญ่มาก"""
+    rng = np.random.default_rng(seed)
+    edges = [limit + delta for limit in tier_limits(rate_structure) for delta in (-EPSILON, 0.0, EPSILON)]
+    special = [0.0, EPSILON, -EPSILON, -1.0, -1e6, 1e6, 1e9, 1e12, 1e15]
+    return np.r_[rng.uniform(0, 2000, n_random), rng.uniform(0, 1e5, n_random // 5), edges, special]
+
+class TariffArrayTests(unittest.TestCase):
+    def assert_same(self, actual, expected, msg):
+        np.testing.assert_allclose(actual, expected, rtol=1e-12, atol=1e-9, err_msg=msg)
+
+    def test_energy_costs_match_price_bill(self):
+        for customer_type_key, tariff_type_key in tariff_pairs():
+            with self.subTest(customer=customer_type_key, tariff=tariff_type_key):
+                rate_structure = TARIFFS[customer_type_key][tariff_type_key]
+                total_kwh = sample_kwh(rate_structure); kwh_peak = total_kwh * 0.4; kwh_off_peak = total_kwh - kwh_peak
+                expected = [
+                    price_bill(customer_type_key, tariff_type_key, total, peak, off_peak, PERIOD_START, PERIOD_END)['base_energy_cost']
+                    for total, peak, off_peak in zip(total_kwh, kwh_peak, kwh_off_peak)
+                ]
+                self.assert_same(energy_costs(customer_type_key, tariff_type_key, total_kwh, kwh_peak, kwh_off_peak), expected, f"{customer_type_key}/{tariff_type_key}")
+
+    def test_service_charges_match_calculate_service_charge(self):
+        for customer_type_key, tariff_type_key in tariff_pairs():
+            with self.subTest(customer=customer_type_key, tariff=tariff_type_key):
+                rate_structure = TARIFFS[customer_type_key][tariff_type_key]
+                total_kwh = sample_kwh(rate_structure, seed=1)
+                expected = [calculate_service_charge(total, rate_structure) for total in total_kwh]
+                self.assert_same(service_charges(customer_type_key, tariff_type_key, total_kwh), expected, f"{customer_type_key}/{tariff_type_key}")
+
+    def test_price_bills_match_price_bill(self):
+        for customer_type_key, tariff_type_key in tariff_pairs():
+            with self.subTest(customer=customer_type_key, tariff=tariff_type_key):
+                rate_structure = TARIFFS[customer_type_key][tariff_type_key]
+                rng = np.random.default_rng(2)
+                total_kwh = sample_kwh(rate_structure, seed=2, n_random=100); kwh_peak = total_kwh * rng.uniform(0, 1, len(total_kwh)); kwh_off_peak = total_kwh - kwh_peak
+                ft_cost = total_kwh * 0.3972; demand_kw = rng.uniform(0, 500, len(total_kwh))
+                bills = price_bills(customer_type_key, tariff_type_key, total_kwh, kwh_peak, kwh_off_peak, ft_cost, demand_kw)
+                for key in ('base_energy_cost', 'service_charge', 'demand_charge', 'final_bill'):
+                    expected = [
+                        price_bill(customer_type_key, tariff_type_key, total, peak, off_peak, PERIOD_START, PERIOD_END, prorated_ft_cost=ft, demand_kw=demand)[key]
+                        for total, peak, off_peak, ft, demand in zip(total_kwh, kwh_peak, kwh_off_peak, ft_cost, demand_kw)
+                    ]
+                    self.assert_same(bills[key], expected, f"{customer_type_key}/{tariff_type_key} {key}")
+
+if __name__ == '__main__':
+    unittest.main()